@@ -4,17 +4,25 @@
 Coinglass 日線歷史全量 -> Supabase(Postgres)
 - API 分頁：每請求 <= 4500（v4 限制）；多頁累積；入庫每批 <= 20000
 - 嚴格限流：預設 80 調用/分鐘（CG_QPM 可覆蓋）
+- HTTP：連線池大小 CG_HTTP_POOL（gzip 由 requests 預設的 Accept-Encoding 處理）；回應直接從 bytes 解析 JSON（有 orjson 時優先）
 - 時間統一：ts_utc 為 UTC；date_utc 由 DB 生成欄位
 - 首頁不帶時間只帶 limit 拿最近一頁，再以最老 time 作 end_time 游標往前翻
+- CG_INTERVAL=1d|4h|1h：K 線類任務的粒度；小時級寫入 <表>_4h / <表>_1h（按月分區，SQL/subdaily_partitions.sql）
+- 就緒探測（CG_READY，預設開）：每個端點族先以 1 個小請求確認目標 bar 已出現且內容穩定才開抓；
+  完成後記入 public.ingest_state，同一天同任務的重跑直接略過（CG_FORCE=1 強制重抓）
+- 執行租約（public.ingest_lease）：同粒度已有批次在跑（如 00:01 仍在等就緒）時，後到的批次直接結束
+- CG_INTRADAY=1：盤中輪詢，每輪每序列只抓最新 1–2 根日 K（不翻頁），刷新當日未收盤的 bar
 """
-import os, time, json
+from common import startup
+startup.install()   # CG_IMPORTTIME=1 時回報各模組匯入耗時
+
+import os, re, sys, time, json, importlib
+from functools import partial
 import datetime as dt
 from typing import Dict, Any, List, Tuple, Optional
-import requests
-import psycopg2
-from psycopg2.extras import execute_values
-import socket
-from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from common import metrics, profiling
+from common import storage
+from common.db import managed
 
 REPORT = []
 
@@ -44,7 +52,14 @@ SLEEP = 60.0 / max(min(QPM, 80), 1)
 
 API_PAGE_LIMIT = int(getenv_any(["CG_API_LIMIT"], "4500"))    # v4 單請求上限
 HTTP_TIMEOUT   = float(getenv_any(["CG_TIMEOUT"], "60"))      # 允許外部調整 HTTP 逾時
-MAX_INSERT     = int(getenv_any(["DB_BATCH_LIMIT"], "20000")) # 單批入庫上限
+HTTP_POOL      = int(getenv_any(["CG_HTTP_POOL"], "8"))        # 共用 SESSION 的連線池大小（並行呼叫 req 時）
+MAX_INSERT     = int(getenv_any(["DB_BATCH_LIMIT"], "20000")) # 單批入庫初始列數（之後依 DB_BATCH_TARGET_SEC 自動調整）
+
+# 粒度：1d 寫既有 *_1d 表；4h/1h 寫同欄位的按月分區表（表名把 _1d 換成 _4h/_1h）
+INTERVAL_SECONDS = {"1d": 86400, "4h": 14400, "1h": 3600}
+INTERVAL = getenv_any(["CG_INTERVAL"], "1d")
+if INTERVAL not in INTERVAL_SECONDS:
+    raise SystemExit(f"CG_INTERVAL 只支援 {','.join(INTERVAL_SECONDS)}，收到 {INTERVAL}")
 
 START_DATE = getenv_any(["START_DATE"], "2015-01-01")
 END_DATE   = getenv_any(["END_DATE"],   None)
@@ -70,14 +85,25 @@ def log(msg:str):
     print(f"[{now}] {msg}", flush=True)
 
 # -------- HTTP + 限流 --------
-SESSION = requests.Session()
-if API_KEY:
-    SESSION.headers.update({
-        "accept": "application/json",
-        "User-Agent": "coinglass-supabase-ingestor/1.3",
-        "CG-API-KEY": API_KEY,        # v4 header
-        "coinglassSecret": API_KEY    # 容錯
-    })
+# requests 延後到第一次發請求才匯入（只跑 DB 端工作時不付這筆啟動成本）
+SESSION = None
+def session():
+    global SESSION
+    if SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        SESSION = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL, pool_maxsize=HTTP_POOL)
+        SESSION.mount("https://", adapter)
+        SESSION.mount("http://", adapter)
+        if API_KEY:
+            SESSION.headers.update({
+                "accept": "application/json",
+                "User-Agent": "coinglass-supabase-ingestor/1.3",
+                "CG-API-KEY": API_KEY,        # v4 header
+                "coinglassSecret": API_KEY    # 容錯
+            })
+    return SESSION
 
 _NEXT_AT = 0.0
 def _throttle():
@@ -85,36 +111,14 @@ def _throttle():
     now = time.time()
     if now < _NEXT_AT:
         time.sleep(_NEXT_AT - now)
+        metrics.inc("throttle_wait_seconds", _NEXT_AT - now)
     _NEXT_AT = max(now, _NEXT_AT) + SLEEP
 
 def must_env():
-    if not API_KEY or not DB_URL:
+    if not API_KEY or not (DB_URL or storage.is_local()):
         raise SystemExit("缺少環境變數：COINGLASS_API_KEY/CG_API_KEY 或 SUPABASE_DB_URL/DATABASE_URL")
 
 # -------- 工具 --------
-# --- 新增工具函式：把 DB URL 加上 hostaddr=IPv4，並保留 host 作為 SNI ---
-def _dsn_force_ipv4(dsn: str) -> str:
-    try:
-        u = urlparse(dsn.replace("postgres://", "postgresql://"))
-        if u.scheme not in ("postgresql", "postgres"):
-            return dsn
-        host = u.hostname
-        port = u.port or 5432
-        if not host:
-            return dsn
-        # 解析第一個 IPv4
-        ipv4 = next((ai[4][0] for ai in socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)), None)
-        if not ipv4:
-            return dsn
-        q = dict(parse_qsl(u.query, keep_blank_values=True))
-        # 連線走 IPv4，SNI/證書仍用原 host
-        q.setdefault("hostaddr", ipv4)
-        q.setdefault("sslmode", "require")
-        new = u._replace(query=urlencode(q))
-        return urlunparse(new)
-    except Exception:
-        return dsn
-
 def to_utc_ts(x) -> Optional[dt.datetime]:
     if x is None: return None
     if isinstance(x, (int, float)):
@@ -138,14 +142,31 @@ def to_utc_ts(x) -> Optional[dt.datetime]:
         return x if x.tzinfo else x.replace(tzinfo=dt.timezone.utc)
     return None
 
-def daterange_utc() -> Tuple[int, int]:
+def daterange_utc(interval: str = INTERVAL) -> Tuple[int, int]:
+    """[START_DATE 00:00, 最後一根已收盤 bar 的開盤時間]；END_DATE 含當日最後一根。"""
     s = dt.datetime.strptime(START_DATE, "%Y-%m-%d").replace(tzinfo=dt.timezone.utc)
     if END_DATE:
-        e = dt.datetime.strptime(END_DATE, "%Y-%m-%d").replace(tzinfo=dt.timezone.utc)
-    else:
-        today = dt.datetime.now(dt.timezone.utc).date()
-        e = dt.datetime(today.year, today.month, today.day, tzinfo=dt.timezone.utc) - dt.timedelta(days=1)
-    return int(s.timestamp()*1000), int(e.timestamp()*1000)
+        e = dt.datetime.strptime(END_DATE, "%Y-%m-%d").replace(tzinfo=dt.timezone.utc) + dt.timedelta(days=1)
+        return int(s.timestamp()*1000), int(e.timestamp()*1000) - INTERVAL_SECONDS[interval]*1000
+    return int(s.timestamp()*1000), last_closed_ms(interval)
+
+def last_closed_ms(interval: str = INTERVAL) -> int:
+    """最後一根已收盤 bar 的開盤時間（ms）。"""
+    step = INTERVAL_SECONDS[interval]
+    now = int(time.time())
+    return (now - now % step - step) * 1000
+
+def tname(table: str, interval: str = INTERVAL) -> str:
+    """日線表名換成對應粒度：futures_candles_1d → futures_candles_4h。"""
+    if interval == "1d" or not table.endswith("_1d"):
+        return table
+    return table[:-3] + "_" + interval
+
+def for_interval(sql: str, interval: str = INTERVAL) -> str:
+    """把 upsert SQL 的目標表換成對應粒度（欄位、衝突鍵相同）。"""
+    if interval == "1d":
+        return sql
+    return re.sub(r"(insert\s+into\s+(?:public\.)?\w+)_1d\b", rf"\1_{interval}", sql, count=1, flags=re.I)
 
 def as_list(obj: Any) -> List[Dict[str, Any]]:
     if obj is None: return []
@@ -176,25 +197,74 @@ def fnum(x: Any) -> Optional[float]:
 class ApiError(RuntimeError):
     pass
 
+# JSON 直接從 bytes 解碼；有裝 orjson 就用（快數倍），否則標準庫 json.loads（也接受 bytes）
+_LOADS = None
+def _json_loads(b: bytes):
+    global _LOADS
+    if _LOADS is None:
+        try:
+            import orjson
+            _LOADS = orjson.loads
+        except ImportError:
+            _LOADS = json.loads
+    return _LOADS(b)
+
+def _snippet(body: bytes) -> str:
+    # 只在出錯時解碼前 300 bytes 當錯誤訊息
+    return body[:300].decode("utf-8", "replace").replace("\n", " ")
+
+try:
+    import resource
+    def _maxrss_mb() -> float:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0   # Linux 單位 KB
+except ImportError:   # Windows
+    def _maxrss_mb() -> float:
+        return 0.0
+
+_PAGE_MB = (os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096) / 1048576.0
+
+def _rss_mb() -> Optional[float]:
+    """目前 RSS（/proc/self/statm 第二欄 × 頁大小）；非 Linux 回傳 None。ru_maxrss 只在創新高時變動，不適合算單請求增量。"""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * _PAGE_MB
+    except (OSError, ValueError, IndexError):
+        return None
+
 def req(path: str, params: Dict[str,Any]) -> Any:
     url = BASE.rstrip("/") + path
     _throttle()
+    metrics.inc("http_requests", endpoint=path)
+    cpu0, rss0 = time.process_time(), _rss_mb()
     try:
-        r = SESSION.get(url, params=params, timeout=HTTP_TIMEOUT)
+        with metrics.timer("http_latency_seconds", endpoint=path):
+            r = session().get(url, params=params, timeout=HTTP_TIMEOUT)
     except Exception as e:
+        metrics.inc("http_errors", endpoint=path, kind="network")
         raise ApiError(f"NETWORK {path} {params} -> {e}")
-    txt = r.text[:300].replace("\n"," ")
+    body = r.content
+    metrics.inc("http_bytes", len(body), endpoint=path)
+    metrics.observe("http_payload_bytes", len(body), buckets=metrics.BYTES_BUCKETS, endpoint=path)
     if r.status_code != 200:
-        raise ApiError(f"HTTP {r.status_code} {path} {params} -> {txt}")
+        metrics.inc("http_errors", endpoint=path, kind=f"http_{r.status_code}")
+        raise ApiError(f"HTTP {r.status_code} {path} {params} -> {_snippet(body)}")
     try:
-        obj = r.json()
+        with metrics.timer("json_parse_seconds", endpoint=path):
+            obj = _json_loads(body)
     except Exception:
-        raise ApiError(f"NONJSON {path} {params} -> {txt}")
+        metrics.inc("http_errors", endpoint=path, kind="nonjson")
+        raise ApiError(f"NONJSON {path} {params} -> {_snippet(body)}")
+    finally:
+        # 單請求 CPU（解壓 + 解析）與目前 RSS 的前後差（回應 body 與解析結果仍在引用中），隨 emit_summary 進 run log
+        metrics.observe("http_cpu_seconds", time.process_time() - cpu0, endpoint=path)
+        if rss0 is not None:
+            metrics.observe("http_rss_delta_mb", _rss_mb() - rss0, buckets=metrics.MB_BUCKETS, endpoint=path)
     if isinstance(obj, dict):
         code = str(obj.get("code","0"))
         if code != "0":
             msg = obj.get("msg")
             log(f"[req] {path} code={code} msg={msg}")
+            metrics.inc("http_errors", endpoint=path, kind="code")
             raise ApiError(f"CODE {code} {msg}")
         return obj.get("data", obj)
     return obj
@@ -255,6 +325,7 @@ def pull_range(path: str, base_params: Dict[str,Any], start_ms: int, end_ms: int
             log(f"[pull_range] got={got} cursor={cursor if cursor is not None else 'latest'}")
         except ApiError as e:
             if "limit" in str(e).lower() and base_limit > 4500:
+                metrics.inc("http_retries", endpoint=path, reason="limit")
                 p["limit"] = 4500
                 d = req(path, p)
                 lst = as_list(d)
@@ -267,6 +338,7 @@ def pull_range(path: str, base_params: Dict[str,Any], start_ms: int, end_ms: int
         # 若第一頁沒資料，嘗試補齊 futures/spot 類別參數
         if got == 0 and cursor is None and not tried_aug:
             tried_aug = True
+            metrics.inc("http_retries", endpoint=path, reason="aug")
             p2 = _aug({k:v for k,v in base_params.items()})
             p2["limit"] = base_limit
             try:
@@ -306,6 +378,7 @@ def pull_range(path: str, base_params: Dict[str,Any], start_ms: int, end_ms: int
             break
         cursor = oldest - 1
 
+    metrics.inc("rows_fetched", len(all_rows), endpoint=path)
     if not all_rows:
         return []
     out, seen = [], set()
@@ -318,123 +391,262 @@ def pull_range(path: str, base_params: Dict[str,Any], start_ms: int, end_ms: int
     return out
 
 # -------- DB --------
-# --- 修改 pg()：預設啟用 IPv4；失敗時再重試一次 ---
+# common.db 受管連線：IPv4（DB_FORCE_IPV4，預設開）+ keepalive；斷線時重連並只重跑當前批次
+# statement_timeout 未設 CG_STMT_TIMEOUT 時沿用 PG_STMT_TIMEOUT（預設 30s），逾時批次才會觸發 write_batched 對半重試
 def pg():
-    dsn = DB_URL
-    if getenv_any(["DB_FORCE_IPV4"], "1") == "1":
-        dsn = _dsn_force_ipv4(dsn)
-    try:
-        return psycopg2.connect(dsn)
-    except psycopg2.OperationalError as e:
-        # 若仍遇到網路/解析問題再強制一次
-        if "Network is unreachable" in str(e) or "could not translate host name" in str(e):
-            return psycopg2.connect(_dsn_force_ipv4(DB_URL))
-        raise
+    t = getenv_any(["CG_STMT_TIMEOUT"], "")
+    return managed(dsn=DB_URL, stmt_timeout=int(t) if t else None)
+
+def _unbounded(cur):
+    # 不可拆批的單一語句（rollup 重算、建分區、完成標記）不受連線 statement_timeout 限制；
+    # 逾時無法對半重試，只會讓整個任務失敗。set local 只在本交易內有效
+    cur.execute("set local statement_timeout = 0")
+
+# -------- 入庫事件（LISTEN/NOTIFY → src/etl_feat/worker.py） --------
+NOTIFY_ON      = getenv_any(["CG_NOTIFY"], "1") == "1"
+NOTIFY_CHANNEL = getenv_any(["CG_NOTIFY_CHANNEL"], "cg_ingest")
+
+def _date_span(rows: List[Tuple]) -> Tuple[Optional[dt.date], Optional[dt.date]]:
+    # 每列取第一個日期/時間欄位（ts_utc 或 date_utc）
+    lo = hi = None
+    for r in rows:
+        for v in r:
+            if isinstance(v, dt.date):
+                d = v.astimezone(dt.timezone.utc).date() if isinstance(v, dt.datetime) else v
+                lo = d if lo is None or d < lo else lo
+                hi = d if hi is None or d > hi else hi
+                break
+    return lo, hi
+
+def notify_ingest(cur, table: str, lo: Optional[dt.date], hi: Optional[dt.date], n: int):
+    """在寫入交易內發出 NOTIFY；Postgres 只會在 commit 後送達 listener。"""
+    if not NOTIFY_ON or lo is None:
+        return
+    payload = json.dumps({"table": table, "from": lo.isoformat(), "to": hi.isoformat(), "rows": n})
+    cur.execute("select pg_notify(%s, %s);", (NOTIFY_CHANNEL, payload))
 
 def upsert(conn, sql: str, rows: List[Tuple], table_label: str):
     if not rows:
         log(f"[{table_label}] 無資料可寫入")
         return 0
-    total = 0
-    with conn.cursor() as cur:
-        for i in range(0, len(rows), MAX_INSERT):
-            part = rows[i:i+MAX_INSERT]
-            execute_values(cur, sql, part, page_size=min(MAX_INSERT, 10000))
-            total += len(part)
-    conn.commit()
+    lo, hi = _date_span(rows)
+    if _is_subdaily(table_label):
+        ensure_partitions(conn, table_label, lo, hi)
+    with metrics.timer("db_write_seconds", table=table_label):
+        # 每批各自 commit（批量依該表延遲自適應，逾時對半重試）；NOTIFY 隨最後一批送出
+        total = conn.execute_values(sql, rows, page_size=MAX_INSERT, key=table_label,
+                                    before_commit=lambda cur: notify_ingest(cur, table_label, lo, hi, len(rows)))
+    metrics.inc("rows_written", total, table=table_label)
     log(f"[{table_label}] upsert rows = {total}")
     return total
 
+# 小時級表按月分區（SQL/subdaily_partitions.sql）；寫入前補齊涵蓋月份，同一程序內每個 (表, 月) 只確認一次
+_PARTS_OK: set = set()
+
+def _is_subdaily(table: str) -> bool:
+    return INTERVAL_SECONDS.get(table.rsplit("_", 1)[-1], 86400) < 86400
+
+def ensure_partitions(conn, table: str, lo: dt.date, hi: dt.date) -> int:
+    months = {(y, m) for y in range(lo.year, hi.year + 1) for m in range(1, 13)
+              if (lo.year, lo.month) <= (y, m) <= (hi.year, hi.month)}
+    if all((table, ym) in _PARTS_OK for ym in months):
+        return 0
+    def _ensure(c):
+        with c.cursor() as cur:
+            _unbounded(cur)
+            cur.execute("select public.ensure_month_partitions(%s, %s, %s);", (table, lo, hi))
+            n = cur.fetchone()[0]
+        c.commit()
+        return n
+    n = conn.run_batch(_ensure)
+    _PARTS_OK.update((table, ym) for ym in months)
+    if n:
+        log(f"[{table}] 新建 {n} 個月分區（{lo:%Y-%m}~{hi:%Y-%m}）")
+    return n
+
+_HAS_TABLE: Dict[str, bool] = {}
+def has_table(conn, name: str) -> bool:
+    if name not in _HAS_TABLE:
+        with conn.cursor() as cur:
+            cur.execute("select to_regclass(%s) is not null;", (name,))
+            _HAS_TABLE[name] = bool(cur.fetchone()[0])
+    return _HAS_TABLE[name]
+
 def db_ping(conn):
     with conn.cursor() as cur:
         cur.execute("select current_database(), current_user, current_schema(), inet_server_addr(), inet_server_port();")
         db, usr, sch, ip, port = cur.fetchone()
         log(f"DB 連線 OK → db={db} user={usr} schema={sch} host={ip}:{port}")
 
+# -------- 共用 upsert SQL 與列映射（日批與盤中模式共用） --------
+SQL_FUTURES_CANDLES = """
+insert into futures_candles_1d (exchange, symbol, ts_utc, open, high, low, close, volume_usd)
+values %s
+on conflict (exchange, symbol, ts_utc)
+do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close, volume_usd=excluded.volume_usd;
+"""
+SQL_SPOT_CANDLES = """
+insert into spot_candles_1d (exchange, symbol, ts_utc, open, high, low, close, volume_usd)
+values %s
+on conflict (exchange, symbol, ts_utc)
+do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close, volume_usd=excluded.volume_usd;
+"""
+SQL_OI_AGG = """
+insert into futures_oi_agg_1d (symbol, ts_utc, open, high, low, close, unit)
+values %s
+on conflict (symbol, ts_utc, unit)
+do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close;
+"""
+SQL_FUNDING_OI = """
+insert into funding_oi_weight_1d (symbol, ts_utc, open, high, low, close)
+values %s
+on conflict (symbol, ts_utc)
+do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close;
+"""
+SQL_FUNDING_VOL = """
+insert into funding_vol_weight_1d (symbol, ts_utc, open, high, low, close)
+values %s
+on conflict (symbol, ts_utc)
+do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close;
+"""
+SQL_LIQUIDATION = """
+insert into liquidation_agg_1d (exchange_list, symbol, ts_utc, long_liq_usd, short_liq_usd)
+values %s
+on conflict (exchange_list, symbol, ts_utc)
+do update set long_liq_usd=excluded.long_liq_usd, short_liq_usd=excluded.short_liq_usd;
+"""
+
+def row_candle(ex: str, sym: str, it: Dict[str,Any]) -> Tuple:
+    return (ex, sym, to_utc_ts(it.get("time")),
+            fnum(first(it,"open")), fnum(first(it,"high")),
+            fnum(first(it,"low")),  fnum(first(it,"close")),
+            fnum(first(it,"volume_usd","volume")))
+
+def row_ohlc(c: str, it: Dict[str,Any]) -> Tuple:
+    return (c, to_utc_ts(it.get("time")),
+            fnum(it.get("open")), fnum(it.get("high")),
+            fnum(it.get("low")),  fnum(it.get("close")))
+
+def row_oi_agg(c: str, it: Dict[str,Any]) -> Tuple:
+    return row_ohlc(c, it) + ("usd",)
+
+def row_liquidation(el: str, c: str, it: Dict[str,Any]) -> Tuple:
+    return (el, c, to_utc_ts(it.get("time")),
+            fnum(first(it,"aggregated_long_liquidation_usd","long_liq_usd","long_liquidation_usd")),
+            fnum(first(it,"aggregated_short_liquidation_usd","short_liq_usd","short_liquidation_usd")))
+
 # -------- Ingests --------
-def ingest_futures_candles_1d(conn, exchanges=EXCHANGES, pairs=FUT_PAIRS):
-    table="futures_candles_1d"
-    sql = """
-    insert into futures_candles_1d (exchange, symbol, ts_utc, open, high, low, close, volume_usd)
-    values %s
-    on conflict (exchange, symbol, ts_utc)
-    do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close, volume_usd=excluded.volume_usd;
-    """
-    s_ms, e_ms = daterange_utc()
+def ingest_futures_candles_1d(conn, exchanges=EXCHANGES, pairs=FUT_PAIRS, interval: str = INTERVAL):
+    table=tname("futures_candles_1d", interval)
+    sql = SQL_FUTURES_CANDLES
+    s_ms, e_ms = daterange_utc(interval)
     for ex in exchanges:
         for sym in pairs:
             s_date = dt.datetime.fromtimestamp(s_ms/1000, tz=dt.timezone.utc).date()
             e_date = dt.datetime.fromtimestamp(e_ms/1000, tz=dt.timezone.utc).date()
             log(f"[{table}] {ex} {sym} 拉取 {s_date}~{e_date}")
             lst = pull_range("/api/futures/price/history",
-                             {"exchange":ex, "symbol":sym, "interval":"1d"}, s_ms, e_ms, "time")
+                             {"exchange":ex, "symbol":sym, "interval":interval}, s_ms, e_ms, "time")
             log(f"[{table}] {ex} {sym} 得 {len(lst)} 行")
-            rows=[]
-            for it in lst:
-                rows.append((ex, sym, to_utc_ts(it.get("time")),
-                             fnum(first(it,"open")), fnum(first(it,"high")),
-                             fnum(first(it,"low")),  fnum(first(it,"close")),
-                             fnum(first(it,"volume_usd","volume"))))
-            upsert(conn, sql, rows, table)
-
-def ingest_spot_candles_1d(conn, exchanges=EXCHANGES, pairs=SPOT_PAIRS):
-    table="spot_candles_1d"
-    sql = """
-    insert into spot_candles_1d (exchange, symbol, ts_utc, open, high, low, close, volume_usd)
-    values %s
-    on conflict (exchange, symbol, ts_utc)
-    do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close, volume_usd=excluded.volume_usd;
-    """
-    s_ms, e_ms = daterange_utc()
+            rows = [row_candle(ex, sym, it) for it in lst]
+            upsert(conn, for_interval(sql, interval), rows, table)
+
+def ingest_spot_candles_1d(conn, exchanges=EXCHANGES, pairs=SPOT_PAIRS, interval: str = INTERVAL):
+    table=tname("spot_candles_1d", interval)
+    touched: Dict[str, List[dt.datetime]] = {}
+    sql = SQL_SPOT_CANDLES
+    s_ms, e_ms = daterange_utc(interval)
     for ex in exchanges:
         for sym in pairs:
             s_date = dt.datetime.fromtimestamp(s_ms/1000, tz=dt.timezone.utc).date()
             e_date = dt.datetime.fromtimestamp(e_ms/1000, tz=dt.timezone.utc).date()
             log(f"[{table}] {ex} {sym} 拉取 {s_date}~{e_date}")
             lst = pull_range("/api/spot/price/history",
-                             {"exchange":ex, "symbol":sym, "interval":"1d"}, s_ms, e_ms, "time")
+                             {"exchange":ex, "symbol":sym, "interval":interval}, s_ms, e_ms, "time")
             log(f"[{table}] {ex} {sym} 得 {len(lst)} 行")
-            rows=[]
-            for it in lst:
-                rows.append((ex, sym, to_utc_ts(it.get("time")),
-                             fnum(first(it,"open")), fnum(first(it,"high")),
-                             fnum(first(it,"low")),  fnum(first(it,"close")),
-                             fnum(first(it,"volume_usd","volume"))))
-            upsert(conn, sql, rows, table)
-
-def ingest_oi_agg_1d(conn, coins=COINS):
-    table="futures_oi_agg_1d"
+            rows = [row_candle(ex, sym, it) for it in lst]
+            upsert(conn, for_interval(sql, interval), rows, table)
+            if interval == "1d":   # 資產層 rollup 只有日線
+                _touch_spot(touched, sym, rows)
+    for asset, ts in touched.items():
+        refresh_spot_asset_1d(conn, [asset], min(ts), max(ts))
+
+def _touch_spot(touched: Dict[str, List[dt.datetime]], sym: str, rows: List[Tuple]):
+    ts = [r[2] for r in rows if r[2] is not None]
+    if ts:
+        touched.setdefault(spot_asset(sym), []).extend((min(ts), max(ts)))
+
+# -------- 資產層 rollup（SQL/spot_asset_1d.sql） --------
+SPOT_QUOTES = ("USDT", "USDC", "BUSD", "TUSD", "USD")
+
+def spot_asset(sym: str) -> str:
+    s = sym.upper()
+    for q in SPOT_QUOTES:
+        if s.endswith(q):
+            return s[:-len(q)]
+    return s
+
+def refresh_spot_asset_1d(conn, assets: List[str], ts_from: dt.datetime, ts_to: dt.datetime) -> int:
+    """重算 spot_asset_1d 中 assets × [ts_from, ts_to] 的聚合（跨所有交易所/報價幣）。"""
+    table = "spot_asset_1d"
+    if not has_table(conn, "public.spot_asset_1d"):
+        return 0
+    # 只展開成該資產可能的 symbol 候選，讓來源篩選可走 (symbol, ts_utc) 索引
+    symbols = [a + q for a in assets for q in ("",) + SPOT_QUOTES]
     sql = """
-    insert into futures_oi_agg_1d (symbol, ts_utc, open, high, low, close, unit)
-    values %s
-    on conflict (symbol, ts_utc, unit)
-    do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close;
+    insert into public.spot_asset_1d (asset, ts_utc, px_open, px_high, px_low, px_close, vol_usd, n_src, updated_at)
+    select
+      regexp_replace(upper(symbol), '(USDT|USDC|BUSD|TUSD|USD)$', '') as asset,
+      ts_utc,
+      avg(open::double precision), avg(high::double precision),
+      avg(low::double precision),  avg(close::double precision),
+      sum(volume_usd::double precision), count(*), now()
+    from public.spot_candles_1d
+    where symbol = any(%s) and ts_utc between %s and %s
+      and regexp_replace(upper(symbol), '(USDT|USDC|BUSD|TUSD|USD)$', '') = any(%s)
+    group by 1, 2
+    on conflict (asset, ts_utc) do update set
+      px_open=excluded.px_open, px_high=excluded.px_high, px_low=excluded.px_low,
+      px_close=excluded.px_close, vol_usd=excluded.vol_usd, n_src=excluded.n_src,
+      updated_at=now();
     """
-    s_ms, e_ms = daterange_utc()
+    def _refresh(c):
+        with c.cursor() as cur:
+            _unbounded(cur)
+            cur.execute(sql, (symbols, ts_from, ts_to, assets))
+            n = cur.rowcount
+            notify_ingest(cur, table, ts_from.date(), ts_to.date(), n)
+        c.commit()
+        return n
+    n = conn.run_batch(_refresh)
+    log(f"[{table}] {','.join(assets)} rollup {ts_from.date()}~{ts_to.date()} rows = {n}")
+    return n
+
+def ingest_oi_agg_1d(conn, coins=COINS, interval: str = INTERVAL):
+    table=tname("futures_oi_agg_1d", interval)
+    sql = SQL_OI_AGG
+    s_ms, e_ms = daterange_utc(interval)
     rows=[]
     for c in coins:
         lst = pull_range("/api/futures/open-interest/aggregated-history",
-                         {"symbol":c, "interval":"1d", "unit":"usd"}, s_ms, e_ms, "time")
+                         {"symbol":c, "interval":interval, "unit":"usd"}, s_ms, e_ms, "time")
         log(f"[{table}] {c} 得 {len(lst)} 行")
-        for it in lst:
-            rows.append((c, to_utc_ts(it.get("time")),
-                         fnum(it.get("open")), fnum(it.get("high")),
-                         fnum(it.get("low")),  fnum(it.get("close")), "usd"))
-    upsert(conn, sql, rows, table)
+        rows.extend(row_oi_agg(c, it) for it in lst)
+    upsert(conn, for_interval(sql, interval), rows, table)
 
-def ingest_oi_stable_1d(conn, coins=COINS, exlists=EXLISTS):
-    table="futures_oi_stablecoin_1d"
+def ingest_oi_stable_1d(conn, coins=COINS, exlists=EXLISTS, interval: str = INTERVAL):
+    table=tname("futures_oi_stablecoin_1d", interval)
     sql = """
     insert into futures_oi_stablecoin_1d (exchange_list, symbol, ts_utc, open, high, low, close)
     values %s
     on conflict (exchange_list, symbol, ts_utc)
     do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close;
     """
-    s_ms, e_ms = daterange_utc()
+    s_ms, e_ms = daterange_utc(interval)
     rows=[]
     for el in exlists:
         for c in coins:
-            base = {"exchange_list":el, "symbol":c, "interval":"1d"}
+            base = {"exchange_list":el, "symbol":c, "interval":interval}
             # 僅對 BTC 降低單請求上限，降低超時風險
             if c == "BTC" and API_PAGE_LIMIT > 3000:
                 base["limit"] = 3000
@@ -445,65 +657,48 @@ def ingest_oi_stable_1d(conn, coins=COINS, exlists=EXLISTS):
                 rows.append((el, c, to_utc_ts(it.get("time")),
                              fnum(it.get("open")), fnum(it.get("high")),
                              fnum(it.get("low")),  fnum(it.get("close"))))
-    upsert(conn, sql, rows, table)
+    upsert(conn, for_interval(sql, interval), rows, table)
 
-def ingest_oi_coinm_1d(conn, coins=COINS, exlists=EXLISTS):
-    table="futures_oi_coin_margin_1d"
+def ingest_oi_coinm_1d(conn, coins=COINS, exlists=EXLISTS, interval: str = INTERVAL):
+    table=tname("futures_oi_coin_margin_1d", interval)
     sql = """
     insert into futures_oi_coin_margin_1d (exchange_list, symbol, ts_utc, open, high, low, close)
     values %s
     on conflict (exchange_list, symbol, ts_utc)
     do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close;
     """
-    s_ms, e_ms = daterange_utc()
+    s_ms, e_ms = daterange_utc(interval)
     rows=[]
     for el in exlists:
         for c in coins:
             lst = pull_range("/api/futures/open-interest/aggregated-coin-margin-history",
-                             {"exchange_list":el, "symbol":c, "interval":"1d"}, s_ms, e_ms, "time")
+                             {"exchange_list":el, "symbol":c, "interval":interval}, s_ms, e_ms, "time")
             log(f"[{table}] {el}|{c} 得 {len(lst)} 行")
             for it in lst:
                 rows.append((el, c, to_utc_ts(it.get("time")),
                              fnum(it.get("open")), fnum(it.get("high")),
                              fnum(it.get("low")),  fnum(it.get("close"))))
-    upsert(conn, sql, rows, table)
+    upsert(conn, for_interval(sql, interval), rows, table)
 
-def ingest_funding_1d(conn, coins=COINS):
-    t1, t2 = "funding_oi_weight_1d","funding_vol_weight_1d"
-    sql_oi = """
-    insert into funding_oi_weight_1d (symbol, ts_utc, open, high, low, close)
-    values %s
-    on conflict (symbol, ts_utc)
-    do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close;
-    """
-    sql_vol = """
-    insert into funding_vol_weight_1d (symbol, ts_utc, open, high, low, close)
-    values %s
-    on conflict (symbol, ts_utc)
-    do update set open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close;
-    """
-    s_ms, e_ms = daterange_utc()
+def ingest_funding_1d(conn, coins=COINS, interval: str = INTERVAL):
+    t1, t2 = tname("funding_oi_weight_1d", interval), tname("funding_vol_weight_1d", interval)
+    sql_oi, sql_vol = SQL_FUNDING_OI, SQL_FUNDING_VOL
+    s_ms, e_ms = daterange_utc(interval)
     rows_oi, rows_vol = [], []
     for c in coins:
         l1 = pull_range("/api/futures/funding-rate/oi-weight-history",
-                        {"symbol":c, "interval":"1d"}, s_ms, e_ms, "time")
+                        {"symbol":c, "interval":interval}, s_ms, e_ms, "time")
         log(f"[{t1}] {c} 得 {len(l1)} 行")
-        for it in l1:
-            rows_oi.append((c, to_utc_ts(it.get("time")),
-                            fnum(it.get("open")), fnum(it.get("high")),
-                            fnum(it.get("low")),  fnum(it.get("close"))))
+        rows_oi.extend(row_ohlc(c, it) for it in l1)
         l2 = pull_range("/api/futures/funding-rate/vol-weight-history",
-                        {"symbol":c, "interval":"1d"}, s_ms, e_ms, "time")
+                        {"symbol":c, "interval":interval}, s_ms, e_ms, "time")
         log(f"[{t2}] {c} 得 {len(l2)} 行")
-        for it in l2:
-            rows_vol.append((c, to_utc_ts(it.get("time")),
-                             fnum(it.get("open")), fnum(it.get("high")),
-                             fnum(it.get("low")),  fnum(it.get("close"))))
-    upsert(conn, sql_oi, rows_oi, t1)
-    upsert(conn, sql_vol, rows_vol, t2)
+        rows_vol.extend(row_ohlc(c, it) for it in l2)
+    upsert(conn, for_interval(sql_oi, interval), rows_oi, t1)
+    upsert(conn, for_interval(sql_vol, interval), rows_vol, t2)
 
-def ingest_long_short_1d(conn, exchanges=EXCHANGES, pairs=FUT_PAIRS):
-    t1,t2,t3 = "long_short_global_1d","long_short_top_accounts_1d","long_short_top_positions_1d"
+def ingest_long_short_1d(conn, exchanges=EXCHANGES, pairs=FUT_PAIRS, interval: str = INTERVAL):
+    t1,t2,t3 = tname("long_short_global_1d", interval), tname("long_short_top_accounts_1d", interval), tname("long_short_top_positions_1d", interval)
     sql1 = """
     insert into long_short_global_1d (exchange, symbol, ts_utc, long_percent, short_percent, long_short_ratio)
     values %s
@@ -522,12 +717,12 @@ def ingest_long_short_1d(conn, exchanges=EXCHANGES, pairs=FUT_PAIRS):
     on conflict (exchange, symbol, ts_utc)
     do update set long_percent=excluded.long_percent, short_percent=excluded.short_percent, long_short_ratio=excluded.long_short_ratio;
     """
-    s_ms, e_ms = daterange_utc()
+    s_ms, e_ms = daterange_utc(interval)
     rows1, rows2, rows3 = [], [], []
     for ex in exchanges:
         for sym in pairs:
             l1 = pull_range("/api/futures/global-long-short-account-ratio/history",
-                            {"exchange":ex, "symbol":sym, "interval":"1d"}, s_ms, e_ms, "time")
+                            {"exchange":ex, "symbol":sym, "interval":interval}, s_ms, e_ms, "time")
             log(f"[{t1}] {ex}|{sym} 得 {len(l1)} 行")
             for it in l1:
                 rows1.append((ex, sym, to_utc_ts(it.get("time")),
@@ -535,7 +730,7 @@ def ingest_long_short_1d(conn, exchanges=EXCHANGES, pairs=FUT_PAIRS):
                               fnum(first(it,"global_account_short_percent")),
                               fnum(first(it,"global_account_long_short_ratio"))))
             l2 = pull_range("/api/futures/top-long-short-account-ratio/history",
-                            {"exchange":ex, "symbol":sym, "interval":"1d"}, s_ms, e_ms, "time")
+                            {"exchange":ex, "symbol":sym, "interval":interval}, s_ms, e_ms, "time")
             log(f"[{t2}] {ex}|{sym} 得 {len(l2)} 行")
             for it in l2:
                 rows2.append((ex, sym, to_utc_ts(it.get("time")),
@@ -543,52 +738,44 @@ def ingest_long_short_1d(conn, exchanges=EXCHANGES, pairs=FUT_PAIRS):
                               fnum(first(it,"top_account_short_percent")),
                               fnum(first(it,"top_account_long_short_ratio"))))
             l3 = pull_range("/api/futures/top-long-short-position-ratio/history",
-                            {"exchange":ex, "symbol":sym, "interval":"1d"}, s_ms, e_ms, "time")
+                            {"exchange":ex, "symbol":sym, "interval":interval}, s_ms, e_ms, "time")
             log(f"[{t3}] {ex}|{sym} 得 {len(l3)} 行")
             for it in l3:
                 rows3.append((ex, sym, to_utc_ts(it.get("time")),
                               fnum(first(it,"top_position_long_percent")),
                               fnum(first(it,"top_position_short_percent")),
                               fnum(first(it,"top_position_long_short_ratio"))))
-    upsert(conn, sql1, rows1, t1)
-    upsert(conn, sql2, rows2, t2)
-    upsert(conn, sql3, rows3, t3)
-
-def ingest_liquidation_1d(conn, coins=COINS, exlists=EXLISTS):
-    table="liquidation_agg_1d"
-    sql = """
-    insert into liquidation_agg_1d (exchange_list, symbol, ts_utc, long_liq_usd, short_liq_usd)
-    values %s
-    on conflict (exchange_list, symbol, ts_utc)
-    do update set long_liq_usd=excluded.long_liq_usd, short_liq_usd=excluded.short_liq_usd;
-    """
-    s_ms, e_ms = daterange_utc()
+    upsert(conn, for_interval(sql1, interval), rows1, t1)
+    upsert(conn, for_interval(sql2, interval), rows2, t2)
+    upsert(conn, for_interval(sql3, interval), rows3, t3)
+
+def ingest_liquidation_1d(conn, coins=COINS, exlists=EXLISTS, interval: str = INTERVAL):
+    table=tname("liquidation_agg_1d", interval)
+    sql = SQL_LIQUIDATION
+    s_ms, e_ms = daterange_utc(interval)
     rows=[]
     for el in exlists:
         for c in coins:
             l = pull_range("/api/futures/liquidation/aggregated-history",
-                           {"exchange_list":el, "symbol":c, "interval":"1d"}, s_ms, e_ms, "time")
+                           {"exchange_list":el, "symbol":c, "interval":interval}, s_ms, e_ms, "time")
             log(f"[{table}] {el}|{c} 得 {len(l)} 行")
-            for it in l:
-                rows.append((el, c, to_utc_ts(it.get("time")),
-                             fnum(first(it,"aggregated_long_liquidation_usd","long_liq_usd","long_liquidation_usd")),
-                             fnum(first(it,"aggregated_short_liquidation_usd","short_liq_usd","short_liquidation_usd"))))
-    upsert(conn, sql, rows, table)
+            rows.extend(row_liquidation(el, c, it) for it in l)
+    upsert(conn, for_interval(sql, interval), rows, table)
 
-def ingest_orderbook_agg_futures_1d(conn, coins=COINS, exlists=EXLISTS, range_pct="1"):
-    table="orderbook_agg_futures_1d"
+def ingest_orderbook_agg_futures_1d(conn, coins=COINS, exlists=EXLISTS, range_pct="1", interval: str = INTERVAL):
+    table=tname("orderbook_agg_futures_1d", interval)
     sql = """
     insert into orderbook_agg_futures_1d (exchange_list, symbol, ts_utc, bids_usd, bids_qty, asks_usd, asks_qty, range_pct)
     values %s
     on conflict (exchange_list, symbol, ts_utc, range_pct)
     do update set bids_usd=excluded.bids_usd, bids_qty=excluded.bids_qty, asks_usd=excluded.asks_usd, asks_qty=excluded.asks_qty;
     """
-    s_ms, e_ms = daterange_utc()
+    s_ms, e_ms = daterange_utc(interval)
     rows=[]
     for el in exlists:
         for c in coins:
             l = pull_range("/api/futures/orderbook/aggregated-ask-bids-history",
-                           {"exchange_list":el, "symbol":c, "interval":"1d", "range":range_pct}, s_ms, e_ms, "time")
+                           {"exchange_list":el, "symbol":c, "interval":interval, "range":range_pct}, s_ms, e_ms, "time")
             log(f"[{table}] {el}|{c} 得 {len(l)} 行")
             for it in l:
                 rows.append((el, c, to_utc_ts(it.get("time")),
@@ -597,28 +784,28 @@ def ingest_orderbook_agg_futures_1d(conn, coins=COINS, exlists=EXLISTS, range_pc
                              fnum(first(it,"aggregated_asks_usd","asks_usd")),
                              fnum(first(it,"aggregated_asks_quantity","asks_qty")),
                              fnum(range_pct)))
-    upsert(conn, sql, rows, table)
+    upsert(conn, for_interval(sql, interval), rows, table)
 
-def ingest_taker_vol_futures_1d(conn, coins=COINS, exlists=EXLISTS):
-    table="taker_vol_agg_futures_1d"
+def ingest_taker_vol_futures_1d(conn, coins=COINS, exlists=EXLISTS, interval: str = INTERVAL):
+    table=tname("taker_vol_agg_futures_1d", interval)
     sql = """
     insert into taker_vol_agg_futures_1d (exchange_list, symbol, ts_utc, buy_vol_usd, sell_vol_usd)
     values %s
     on conflict (exchange_list, symbol, ts_utc)
     do update set buy_vol_usd=excluded.buy_vol_usd, sell_vol_usd=excluded.sell_vol_usd;
     """
-    s_ms, e_ms = daterange_utc()
+    s_ms, e_ms = daterange_utc(interval)
     rows=[]
     for el in exlists:
         for c in coins:
             l = pull_range("/api/futures/aggregated-taker-buy-sell-volume/history",
-                           {"exchange_list":el, "symbol":c, "interval":"1d", "unit":"usd"}, s_ms, e_ms, "time")
+                           {"exchange_list":el, "symbol":c, "interval":interval, "unit":"usd"}, s_ms, e_ms, "time")
             log(f"[{table}] {el}|{c} 得 {len(l)} 行")
             for it in l:
                 rows.append((el, c, to_utc_ts(it.get("time")),
                              fnum(first(it,"aggregated_buy_volume_usd","buy_vol_usd","buy_volume_usd")),
                              fnum(first(it,"aggregated_sell_volume_usd","sell_vol_usd","sell_volume_usd"))))
-    upsert(conn, sql, rows, table)
+    upsert(conn, for_interval(sql, interval), rows, table)
 
 def ingest_etf_bitcoin_flow_and_aum(conn):
     t_flow, t_aum = "etf_bitcoin_flow_1d", "etf_bitcoin_net_assets_1d"
@@ -694,61 +881,61 @@ def ingest_hk_etf_flow(conn):
         rows.append((date_utc, flow, price, json.dumps(details)))
     upsert(conn, sql, rows, table)
 
-def ingest_coinbase_premium_index_1d(conn):
-    table="coinbase_premium_index_1d"
+def ingest_coinbase_premium_index_1d(conn, interval: str = INTERVAL):
+    table=tname("coinbase_premium_index_1d", interval)
     sql = """
     insert into coinbase_premium_index_1d (ts_utc, premium_usd, premium_rate)
     values %s
     on conflict (ts_utc) do update set premium_usd=excluded.premium_usd, premium_rate=excluded.premium_rate;
     """
-    s_ms, e_ms = daterange_utc()
+    s_ms, e_ms = daterange_utc(interval)
     lst = pull_range("/api/coinbase-premium-index",
-                     {"interval":"1d"}, s_ms, e_ms, "time")
+                     {"interval":interval}, s_ms, e_ms, "time")
     log(f"[{table}] 得 {len(lst)} 行")
     rows=[]
     for it in lst:
         rows.append((to_utc_ts(first(it,"time","timestamp")),
                      fnum(first(it,"premium","premium_usd")),
                      fnum(first(it,"premium_rate","rate"))))
-    upsert(conn, sql, rows, table)
+    upsert(conn, for_interval(sql, interval), rows, table)
 
-def ingest_bitfinex_margin_ls_1d(conn, coins=COINS):
-    table="bitfinex_margin_long_short_1d"
+def ingest_bitfinex_margin_ls_1d(conn, coins=COINS, interval: str = INTERVAL):
+    table=tname("bitfinex_margin_long_short_1d", interval)
     sql = """
     insert into bitfinex_margin_long_short_1d (symbol, ts_utc, long_qty, short_qty)
     values %s
     on conflict (symbol, ts_utc) do update set long_qty=excluded.long_qty, short_qty=excluded.short_qty;
     """
-    s_ms, e_ms = daterange_utc()
+    s_ms, e_ms = daterange_utc(interval)
     rows=[]
     for c in coins:
         lst = pull_range("/api/bitfinex-margin-long-short",
-                         {"symbol":c, "interval":"1d"}, s_ms, e_ms, "time")
+                         {"symbol":c, "interval":interval}, s_ms, e_ms, "time")
         log(f"[{table}] {c} 得 {len(lst)} 行")
         for it in lst:
             rows.append((c, to_utc_ts(first(it,"time","timestamp")),
                          fnum(first(it,"long_quantity","long_qty")),
                          fnum(first(it,"short_quantity","short_qty"))))
-    upsert(conn, sql, rows, table)
+    upsert(conn, for_interval(sql, interval), rows, table)
 
-def ingest_borrow_ir_1d(conn, exchanges=EXCHANGES, coins=COINS):
-    table="borrow_interest_rate_1d"
+def ingest_borrow_ir_1d(conn, exchanges=EXCHANGES, coins=COINS, interval: str = INTERVAL):
+    table=tname("borrow_interest_rate_1d", interval)
     sql = """
     insert into borrow_interest_rate_1d (exchange, symbol, ts_utc, interest_rate)
     values %s
     on conflict (exchange, symbol, ts_utc) do update set interest_rate=excluded.interest_rate;
     """
-    s_ms, e_ms = daterange_utc()
+    s_ms, e_ms = daterange_utc(interval)
     rows=[]
     for ex in exchanges:
         for c in coins:
             lst = pull_range("/api/borrow-interest-rate/history",
-                             {"exchange":ex, "symbol":c, "interval":"1d"}, s_ms, e_ms, "time")
+                             {"exchange":ex, "symbol":c, "interval":interval}, s_ms, e_ms, "time")
             log(f"[{table}] {ex}|{c} 得 {len(lst)} 行")
             for it in lst:
                 rows.append((ex, c, to_utc_ts(first(it,"time","timestamp")),
                              fnum(first(it,"interest_rate","rate"))))
-    upsert(conn, sql, rows, table)
+    upsert(conn, for_interval(sql, interval), rows, table)
 
 def ingest_indices_daily(conn):
     t1,t2,t3 = "idx_puell_multiple_daily","idx_stock_to_flow_daily","idx_pi_cycle_daily"
@@ -776,21 +963,289 @@ def ingest_indices_daily(conn):
         rows.append((date_utc, fnum(first(it,"price","price_usd")), fnum(first(it,"ma_110")), fnum(ma350x2)))
     upsert(conn, sql_pi, rows, t3)
 
-# 匯入新 ETL
-from src.etl_raw.futures_basis_1d import ingest_futures_basis_1d
-from src.etl_raw.futures_whale_index_1d import ingest_futures_whale_index_1d
-from src.etl_raw.futures_cgdi_index_1d import ingest_futures_cgdi_index_1d
-from src.etl_raw.futures_cdri_index_1d import ingest_futures_cdri_index_1d
+# 擴充 ETL（src/etl_raw）：只在任務被選中時才匯入
+def etl_raw(module: str, func: str):
+    # 擴充模組以 `from dataupsert import ...` 取用本檔工具；以 `python -m Dataupsert` 執行時本檔是 __main__，
+    # 先把小寫/原名都登記成目前這份模組，避免 Linux 上找不到 dataupsert 或再載入第二份（第二份有自己的限流狀態）
+    me = sys.modules[__name__]
+    sys.modules.setdefault("dataupsert", me)
+    sys.modules.setdefault("Dataupsert", me)
+    return getattr(importlib.import_module(f"src.etl_raw.{module}"), func)
+
+# -------- 盤中模式（CG_INTRADAY=1）：只刷新當日未收盤的日 K --------
+INTRADAY_EVERY  = float(getenv_any(["CG_INTRADAY_EVERY"], "300"))  # 每輪間隔（秒）
+INTRADAY_HEAD   = int(getenv_any(["CG_INTRADAY_HEAD"], "2"))       # 每序列取最新幾根（昨日收盤 + 今日未收盤）
+INTRADAY_BUDGET = int(getenv_any(["CG_INTRADAY_BUDGET"], "0"))     # 每輪請求上限；0 = 該輪 CG_QPM 額度的一半
+INTRADAY_CYCLES = int(getenv_any(["CG_INTRADAY_CYCLES"], "0"))     # 跑幾輪後結束；0 = 持續執行
+# 暫停時段（UTC，"HH:MM-HH:MM"，可跨午夜；逗號分隔多段）：與夜間批次共用同一把 API key，
+# 兩者同時跑會合計超過 key 的 80 req/min 而互相吃 429，夜間批次時段內盤中模式整輪略過
+INTRADAY_PAUSE  = getenv_any(["CG_INTRADAY_PAUSE"], "")
+
+def _parse_pause(spec: str) -> List[Tuple[int, int]]:
+    out = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        a, b = (x.strip() for x in part.split("-"))
+        ha, ma = a.split(":"); hb, mb = b.split(":")
+        out.append((int(ha)*60 + int(ma), int(hb)*60 + int(mb)))
+    return out
+
+def intraday_paused(now: Optional[dt.datetime] = None, spec: str = INTRADAY_PAUSE) -> bool:
+    now = now or dt.datetime.now(dt.timezone.utc)
+    m = now.hour*60 + now.minute
+    for lo, hi in _parse_pause(spec):
+        if (lo <= m < hi) if lo <= hi else (m >= lo or m < hi):
+            return True
+    return False
+
+def intraday_series(interval: str = INTERVAL) -> List[Tuple]:
+    """盤中要刷新的序列：(table, path, params, sql, mapper, spot_symbol)。"""
+    out = []
+    for ex in EXCHANGES:
+        for sym in FUT_PAIRS:
+            out.append((tname("futures_candles_1d", interval), "/api/futures/price/history",
+                        {"exchange":ex, "symbol":sym, "interval":interval}, for_interval(SQL_FUTURES_CANDLES, interval), partial(row_candle, ex, sym), None))
+        for sym in SPOT_PAIRS:
+            out.append((tname("spot_candles_1d", interval), "/api/spot/price/history",
+                        {"exchange":ex, "symbol":sym, "interval":interval}, for_interval(SQL_SPOT_CANDLES, interval), partial(row_candle, ex, sym), sym if interval == "1d" else None))
+    for c in COINS:
+        out.append((tname("futures_oi_agg_1d", interval), "/api/futures/open-interest/aggregated-history",
+                    {"symbol":c, "interval":interval, "unit":"usd"}, for_interval(SQL_OI_AGG, interval), partial(row_oi_agg, c), None))
+        out.append((tname("funding_oi_weight_1d", interval), "/api/futures/funding-rate/oi-weight-history",
+                    {"symbol":c, "interval":interval}, for_interval(SQL_FUNDING_OI, interval), partial(row_ohlc, c), None))
+        out.append((tname("funding_vol_weight_1d", interval), "/api/futures/funding-rate/vol-weight-history",
+                    {"symbol":c, "interval":interval}, for_interval(SQL_FUNDING_VOL, interval), partial(row_ohlc, c), None))
+    for el in EXLISTS:
+        for c in COINS:
+            out.append((tname("liquidation_agg_1d", interval), "/api/futures/liquidation/aggregated-history",
+                        {"exchange_list":el, "symbol":c, "interval":interval}, for_interval(SQL_LIQUIDATION, interval), partial(row_liquidation, el, c), None))
+    return out
+
+def pull_head(path: str, params: Dict[str,Any], n: int = INTRADAY_HEAD) -> List[Dict[str,Any]]:
+    """單一請求：首頁不帶時間、limit=n，即最新 n 根；不走 pull_range 分頁。"""
+    lst = [it for it in as_list(req(path, dict(params, limit=n))) if to_utc_ts(first(it, "time", "timestamp")) is not None]
+    lst.sort(key=lambda it: to_utc_ts(first(it, "time", "timestamp")))
+    return lst[-n:]
+
+def run_intraday():
+    must_env()
+    series = intraday_series()
+    if not series:
+        raise SystemExit("盤中模式沒有可刷新的序列（檢查 CG_EXCHANGES / CG_COINS / CG_EXLISTS）")
+    # 每輪預算：預設只用該輪 QPM 額度的一半，留給同時段的日批；序列多於預算時輪替，數輪內全部覆蓋
+    quota = int(min(QPM, 80) * INTRADAY_EVERY / 60)
+    per_cycle = max(1, min(len(series), INTRADAY_BUDGET or quota // 2, quota))
+    log(f"盤中模式：{len(series)} 個序列，每 {INTRADAY_EVERY:.0f}s 一輪，每輪最多 {per_cycle} 個請求"
+        + (f"，{INTRADAY_PAUSE} UTC 暫停" if INTRADAY_PAUSE else ""))
+    _parse_pause(INTRADAY_PAUSE)   # 格式錯誤在啟動時就拋出
+    conn = pg()
+    db_ping(conn)
+    pos = cycle = 0
+    paused = False
+    while True:
+        t0 = time.time()
+        if intraday_paused():
+            if not paused:
+                log(f"[intraday] 進入暫停時段 {INTRADAY_PAUSE} UTC（讓出 API 額度給夜間批次）")
+            paused = True
+            time.sleep(INTRADAY_EVERY)
+            continue
+        paused = False
+        picked = [series[(pos + i) % len(series)] for i in range(per_cycle)]
+        pos = (pos + per_cycle) % len(series)
+        batches: Dict[str, Tuple[str, List[Tuple]]] = {}
+        touched: Dict[str, List[dt.datetime]] = {}
+        with metrics.timer("task_seconds", task="intraday"):
+            for table, path, params, sql, mapper, spot_sym in picked:
+                try:
+                    rows = [mapper(it) for it in pull_head(path, params)]
+                except ApiError as e:
+                    log(f"[intraday] {table} {params} 失敗：{e}")
+                    continue
+                batches.setdefault(table, (sql, []))[1].extend(rows)
+                if spot_sym:
+                    _touch_spot(touched, spot_sym, rows)
+            # 同表合併成一次 upsert（同輪每序列只出現一次，不會有重複鍵）
+            for table, (sql, rows) in batches.items():
+                upsert(conn, sql, rows, table)
+            for asset, ts in touched.items():
+                refresh_spot_asset_1d(conn, [asset], min(ts), max(ts))
+        metrics.emit_summary("dataupsert_intraday", conn)
+        metrics.reset()
+        cycle += 1
+        if INTRADAY_CYCLES and cycle >= INTRADAY_CYCLES:
+            break
+        time.sleep(max(0.0, INTRADAY_EVERY - (time.time() - t0)))
+    conn.close()
+    log("盤中模式結束")
+
+# -------- 就緒探測 + 每日完成標記（SQL/ingest_state.sql） --------
+READY_ON         = getenv_any(["CG_READY"], "1") == "1"
+READY_STABLE_SEC = float(getenv_any(["CG_READY_STABLE_SEC"], "60"))    # 兩次探測內容相同才算穩定
+READY_BACKOFF    = float(getenv_any(["CG_READY_BACKOFF"], "60"))       # bar 未出現時的首次等待，之後 ×2
+READY_MAX_WAIT   = float(getenv_any(["CG_READY_MAX_BACKOFF"], "600"))
+# 逾時仍照舊開抓，但不記完成；預設 7 分鐘，00:01 批次在 00:10 下一輪之前就開抓
+READY_TIMEOUT    = float(getenv_any(["CG_READY_TIMEOUT"], "420"))
+FORCE            = getenv_any(["CG_FORCE"], "0") == "1"
+LEASE_SEC        = int(getenv_any(["CG_LEASE_SEC"], "1800"))           # 執行租約長度；每完成一個任務續租
+
+def ready_probes() -> Dict[str, Tuple[str, Dict[str,Any]]]:
+    """任務 → 代表端點與最小參數（各族取第一個交易所/幣/交易對；interval 於探測時補上）。"""
+    ex, el = (EXCHANGES or ["Binance"])[0], (EXLISTS or ["Binance"])[0]
+    fut, spot, c = (FUT_PAIRS or ["BTCUSDT"])[0], (SPOT_PAIRS or ["BTCUSDT"])[0], (COINS or ["BTC"])[0]
+    return {
+        "futures_candles_1d":            ("/api/futures/price/history", {"exchange":ex, "symbol":fut}),
+        "spot_candles_1d":               ("/api/spot/price/history", {"exchange":ex, "symbol":spot}),
+        "oi_agg_1d":                     ("/api/futures/open-interest/aggregated-history", {"symbol":c, "unit":"usd"}),
+        "oi_stable_1d":                  ("/api/futures/open-interest/aggregated-stablecoin-history", {"exchange_list":el, "symbol":c}),
+        "oi_coinm_1d":                   ("/api/futures/open-interest/aggregated-coin-margin-history", {"exchange_list":el, "symbol":c}),
+        "funding_1d":                    ("/api/futures/funding-rate/oi-weight-history", {"symbol":c}),
+        "long_short_1d":                 ("/api/futures/global-long-short-account-ratio/history", {"exchange":ex, "symbol":fut}),
+        "liquidation_1d":                ("/api/futures/liquidation/aggregated-history", {"exchange_list":el, "symbol":c}),
+        "orderbook_agg_futures_1d":      ("/api/futures/orderbook/aggregated-ask-bids-history", {"exchange_list":el, "symbol":c, "range":"1"}),
+        "taker_vol_agg_futures_1d":      ("/api/futures/aggregated-taker-buy-sell-volume/history", {"exchange_list":el, "symbol":c, "unit":"usd"}),
+        "coinbase_premium_index_1d":     ("/api/coinbase-premium-index", {}),
+        "bitfinex_margin_long_short_1d": ("/api/bitfinex-margin-long-short", {"symbol":c}),
+        "borrow_interest_rate_1d":       ("/api/borrow-interest-rate/history", {"exchange":ex, "symbol":c}),
+    }
+
+def probe_bar(path: str, params: Dict[str,Any], target_ms: int, interval: str) -> Optional[str]:
+    """單一小請求取最新 2 根；回傳目標 bar 內容（排序後 JSON），尚未出現則回 None。"""
+    metrics.inc("ready_probes", endpoint=path)
+    try:
+        lst = pull_head(path, dict(params, interval=interval), 2)
+    except ApiError as e:
+        log(f"[ready] {path} 探測失敗：{e}")
+        return None
+    for it in lst:
+        ts = to_utc_ts(first(it, "time", "timestamp"))
+        if ts is None:
+            continue
+        if int(ts.timestamp()*1000) == target_ms:
+            return json.dumps(it, sort_keys=True, default=str)
+    return None
+
+def wait_ready(names: List[str], interval: str = INTERVAL) -> set:
+    """探測到目標 bar 已出現且兩次內容一致的任務集合；逾時未就緒的不在其中。"""
+    probes = {n: p for n, p in ready_probes().items() if n in names}
+    _, target_ms = daterange_utc(interval)
+    if not probes or target_ms < last_closed_ms(interval):
+        return set(probes)   # 回補歷史區間，資料早已定稿
+    target = dt.datetime.fromtimestamp(target_ms/1000, tz=dt.timezone.utc)
+    log(f"[ready] 探測 {len(probes)} 個端點族，目標 bar {target:%Y-%m-%d %H:%M} UTC")
+    seen: Dict[str, Optional[str]] = {}
+    ready, pending = set(), dict(probes)
+    t0, backoff = time.time(), READY_BACKOFF
+    while pending:
+        for name, (path, params) in list(pending.items()):
+            d = probe_bar(path, params, target_ms, interval)
+            if d is not None and seen.get(name) == d:
+                ready.add(name)
+                pending.pop(name)
+            seen[name] = d
+        if not pending:
+            break
+        # 目標 bar 都已出現只差穩定確認 → 等 STABLE 秒；仍有缺 → 指數退避
+        if all(seen.get(n) for n in pending):
+            wait = READY_STABLE_SEC
+        else:
+            wait, backoff = backoff, min(backoff * 2, READY_MAX_WAIT)
+        if time.time() - t0 + wait > READY_TIMEOUT:
+            log(f"[ready] 逾時，未就緒：{','.join(sorted(pending))}（照舊抓取，但不記完成）")
+            break
+        log(f"[ready] 就緒 {len(ready)}/{len(probes)}，{wait:.0f}s 後重新探測：{','.join(sorted(pending))}")
+        time.sleep(wait)
+    metrics.observe("ready_wait_seconds", time.time() - t0)
+    return ready
+
+def _window() -> Tuple[dt.datetime, dt.datetime]:
+    s_ms, e_ms = daterange_utc(INTERVAL)
+    return (dt.datetime.fromtimestamp(s_ms/1000, tz=dt.timezone.utc),
+            dt.datetime.fromtimestamp(e_ms/1000, tz=dt.timezone.utc))
+
+def is_done(conn, task: str) -> bool:
+    """今天這個任務是否已在「完整資料」上抓過且涵蓋本次區間。"""
+    if FORCE or not has_table(conn, "public.ingest_state"):
+        return False
+    start, target = _window()
+    with conn.cursor() as cur:
+        cur.execute("select 1 from public.ingest_state where task=%s and interval=%s and target_ts=%s and start_ts<=%s;",
+                    (task, INTERVAL, target, start))
+        hit = cur.fetchone() is not None
+    conn.rollback()
+    return hit
+
+def mark_done(conn, task: str):
+    if not has_table(conn, "public.ingest_state"):
+        return
+    start, target = _window()
+    def _mark(c):
+        with c.cursor() as cur:
+            _unbounded(cur)
+            cur.execute("""
+            insert into public.ingest_state (task, interval, target_ts, start_ts, completed_at)
+            values (%s, %s, %s, %s, now())
+            on conflict (task, interval, target_ts)
+            do update set start_ts=least(public.ingest_state.start_ts, excluded.start_ts), completed_at=now();
+            """, (task, INTERVAL, target, start))
+        c.commit()
+    conn.run_batch(_mark)
+
+def acquire_lease(conn, holder: str) -> bool:
+    """同粒度同時只跑一個批次（共用 API key / 限流額度）；租約被他人持有且未逾期回傳 False。
+    public.ingest_lease 不存在時不設限。逾期租約（程式被殺）可直接接手，同一 holder 呼叫即續租。"""
+    if not has_table(conn, "public.ingest_lease"):
+        return True
+    def _acquire(c):
+        with c.cursor() as cur:
+            cur.execute("""
+            insert into public.ingest_lease (interval, holder, expires_at)
+            values (%s, %s, now() + %s * interval '1 second')
+            on conflict (interval) do update set holder=excluded.holder, expires_at=excluded.expires_at
+             where public.ingest_lease.expires_at < now() or public.ingest_lease.holder = excluded.holder;
+            """, (INTERVAL, holder, LEASE_SEC))
+            ok = cur.rowcount == 1
+        c.commit()
+        return ok
+    return conn.run_batch(_acquire)
+
+def release_lease(conn, holder: str):
+    if not has_table(conn, "public.ingest_lease"):
+        return
+    def _release(c):
+        with c.cursor() as cur:
+            cur.execute("delete from public.ingest_lease where interval=%s and holder=%s;", (INTERVAL, holder))
+        c.commit()
+    conn.run_batch(_release)
 
 # -------- 入口 --------
 TASKS = [x.strip() for x in getenv_any(["CG_TASKS","TASKS"], "").split(",") if x.strip()]
+# CG_INTERVAL=4h/1h 時只跑支援小時級的時間序列任務（ETF / 指數類只有日資料）
+SUBDAILY_TASKS = {"futures_candles_1d", "spot_candles_1d", "oi_agg_1d", "oi_stable_1d", "oi_coinm_1d",
+                  "funding_1d", "long_short_1d", "liquidation_1d", "orderbook_agg_futures_1d",
+                  "taker_vol_agg_futures_1d", "coinbase_premium_index_1d", "bitfinex_margin_long_short_1d",
+                  "borrow_interest_rate_1d"}
 
 def run_all():
     must_env()
-    log(f"啟動，限流 {min(QPM,80)} req/min，BASE={BASE}")
+    log(f"啟動，限流 {min(QPM,80)} req/min，粒度 {INTERVAL}，BASE={BASE}")
     conn = pg()
     db_ping(conn)
+    holder = f"{os.getpid()}:{metrics.RUN_ID}"
+    if not acquire_lease(conn, holder):
+        log(f"另一個 {INTERVAL} 批次仍在執行（public.ingest_lease），本次略過")
+        conn.close()
+        return
+    try:
+        _run_pipeline(conn, holder)
+    finally:
+        release_lease(conn, holder)
+    metrics.emit_summary("dataupsert", conn)
+    conn.close()
+    log(f"完成（峰值 RSS {_maxrss_mb():.0f} MB）")
 
+def _run_pipeline(conn, holder: str):
     pipeline = [
         ("futures_candles_1d",             lambda: ingest_futures_candles_1d(conn)),
         ("spot_candles_1d",                lambda: ingest_spot_candles_1d(conn)),
@@ -811,23 +1266,41 @@ def run_all():
         ("indices_daily",                  lambda: ingest_indices_daily(conn)),
 
         # <<< 新增的四個擴充任務 >>>
-        ("futures_basis_1d",               lambda: ingest_futures_basis_1d(conn)),
-        ("futures_whale_index_1d",         lambda: ingest_futures_whale_index_1d(conn)),
-        ("futures_cgdi_index_1d",          lambda: ingest_futures_cgdi_index_1d(conn)),
-        ("futures_cdri_index_1d",          lambda: ingest_futures_cdri_index_1d(conn)),
+        ("futures_basis_1d",               lambda: etl_raw("futures_basis_1d", "ingest_futures_basis_1d")(conn)),
+        ("futures_whale_index_1d",         lambda: etl_raw("futures_whale_index_1d", "ingest_futures_whale_index_1d")(conn)),
+        ("futures_cgdi_index_1d",          lambda: etl_raw("futures_cgdi_index_1d", "ingest_futures_cgdi_index_1d")(conn)),
+        ("futures_cdri_index_1d",          lambda: etl_raw("futures_cdri_index_1d", "ingest_futures_cdri_index_1d")(conn)),
     ]
 
+    selected = [name for name, _ in pipeline
+                if (not TASKS or name in TASKS) and (INTERVAL == "1d" or name in SUBDAILY_TASKS)]
+    todo = [name for name in selected if not is_done(conn, name)]
+    if len(todo) < len(selected):
+        log(f"今日已完成、略過：{','.join(n for n in selected if n not in todo)}（CG_FORCE=1 可強制重抓）")
+    ready = wait_ready(todo) if READY_ON else set()
+
     for name, fn in pipeline:
-        if TASKS and name not in TASKS:
+        if name not in todo:
             continue
-        fn()
-
-    conn.close()
-    log("完成")
+        # task_seconds 扣掉 http/throttle/db 即為 JSON 解析後的列映射等 Python 端時間；
+        # rows_fetched（API）對 rows_written（DB）可看出映射時被濾掉的比例
+        errs0 = metrics.total("http_errors")
+        with metrics.timer("task_seconds", task=name), profiling.profile("dataupsert", name):
+            fn()
+        # pull_range 會吞掉單頁 ApiError（429/逾時等）繼續跑；本任務有任何 HTTP 錯誤就不標記完成，下次重抓
+        if name in ready:
+            if metrics.total("http_errors") == errs0:
+                mark_done(conn, name)
+            else:
+                log(f"[{name}] 期間有 HTTP 錯誤，不標記完成")
+        acquire_lease(conn, holder)   # 續租
 
 if __name__ == "__main__":
     try:
-        run_all()
+        if getenv_any(["CG_INTRADAY"], "0") == "1":
+            run_intraday()
+        else:
+            run_all()
     except Exception as e:
         log(f"致命錯誤：{e}")
         raise
\ No newline at end of file
@@ -0,0 +1,13 @@
+-- 跨資產滾動相關（src/etl_feat/feat_corr.py）的視窗狀態
+-- state 為 numpy .npz：各視窗的成對 n / Σx / Σx² / Σxy（N × N）與最近 max(w) 日報酬緩衝；
+-- through 為已併入的最後一日，之後每次只併入新日、扣掉滑出視窗的日子；表不存在時每次自 since 回溫重算
+
+create table if not exists public.corr_window_state (
+  task text not null,
+  assets jsonb not null,                       -- 矩陣欄位順序
+  through date not null,
+  appended integer not null default 0,         -- 自上次以緩衝精確重算後併入的日數
+  state bytea not null,
+  updated_at timestamp with time zone not null default now(),
+  constraint corr_window_state_pkey primary key (task)
+);
@@ -0,0 +1,18 @@
+-- ext_features 命名空間寫入器（common/feature_store.py）所需結構
+
+-- 以 (asset, date_utc) 合併各特徵模組的命名空間鍵
+create index if not exists features_1d_asset_date_idx on public.features_1d (asset, date_utc);
+
+-- 遮罩/預設鍵（例如 ETH 的 cpi_na=true）已看過的 features_1d.updated_at，之後只處理這之後新增/重寫的列
+create table if not exists public.ext_features_marker (
+  ns text not null,
+  asset text not null,
+  applied_at timestamp with time zone,
+  updated_at timestamp with time zone not null default now(),
+  constraint ext_features_marker_pkey primary key (ns, asset)
+);
+-- 舊版以 date_utc 為水位（applied_through），回補的較早日期會被漏掉；改為 updated_at 後從頭重掃一次
+alter table public.ext_features_marker add column if not exists applied_at timestamp with time zone;
+alter table public.ext_features_marker drop column if exists applied_through;
+
+create index if not exists features_1d_asset_updated_idx on public.features_1d (asset, updated_at);
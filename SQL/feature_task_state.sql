@@ -0,0 +1,12 @@
+-- 特徵任務 DAG 執行器（src/etl_feat/runner.py）的上游水位
+-- source = 上游表名（signature 為整表按月的列數 + 內容摘要 JSON，比對出最早變動月份）或 'task:<name>'（上游任務最後成功時間）；
+-- source = '@self' 為該任務本身最後成功時間，供下游比對
+
+create table if not exists public.feature_task_state (
+  task text not null,
+  source text not null,
+  signature text not null,
+  updated_at timestamp with time zone not null default now(),
+  constraint feature_task_state_pkey primary key (task, source)
+);
+
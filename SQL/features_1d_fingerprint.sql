@@ -0,0 +1,13 @@
+-- featuresETL 每資產輸入指紋：sha256(OHLCV 視窗 + score_ver + since)
+-- 指紋未變的資產整個略過；有變動時只寫回分數超過容差的列（見 featuresETL.changed_rows）
+
+create table if not exists public.features_1d_fingerprint (
+  asset text not null,
+  score_ver text not null,
+  fingerprint text not null,
+  ts_from timestamp with time zone,
+  ts_to timestamp with time zone,
+  n_rows integer,
+  updated_at timestamp with time zone not null default now(),
+  constraint features_1d_fingerprint_pkey primary key (asset, score_ver)
+);
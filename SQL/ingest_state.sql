@@ -0,0 +1,21 @@
+-- Dataupsert 每日完成標記：任務在「就緒探測通過」的完整資料上抓完後寫入一列；
+-- 同一天的重跑（00:10 / 02:20）若 target_ts 相同且 start_ts 已涵蓋本次區間就直接略過（CG_FORCE=1 強制重抓）。
+-- target_ts = 本次區間最後一根已收盤 bar 的開盤時間；start_ts = 已抓過的最早起點。
+
+create table if not exists public.ingest_state (
+  task text not null,
+  interval text not null default '1d',
+  target_ts timestamp with time zone not null,
+  start_ts timestamp with time zone not null,
+  completed_at timestamp with time zone not null default now(),
+  constraint ingest_state_pkey primary key (task, interval, target_ts)
+);
+
+-- 執行租約：同一粒度同時只有一個 Dataupsert 批次（00:01 / 00:05 / 00:10 共用 API key 與限流額度）。
+-- 取不到租約的批次直接結束；每完成一個任務續租 CG_LEASE_SEC 秒，程式被殺時逾期後可被接手。
+create table if not exists public.ingest_lease (
+  interval text not null,
+  holder text not null,
+  expires_at timestamp with time zone not null,
+  constraint ingest_lease_pkey primary key (interval)
+);
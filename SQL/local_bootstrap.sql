@@ -0,0 +1,58 @@
+-- 本機嵌入式 Postgres（CG_STORAGE=local，common/storage.py）建庫時補上 schema.sql 沒列出的表；
+-- 線上庫已存在這些表，此檔只在本機初始化時套用。
+
+create table if not exists public.features_1d (
+  asset text not null,
+  ts_utc timestamp with time zone not null,
+  date_utc date generated always as ((ts_utc at time zone 'UTC')::date) stored,
+  px_open double precision,
+  px_high double precision,
+  px_low double precision,
+  px_close double precision,
+  vol_usd double precision,
+  score_trend double precision,
+  score_osc double precision,
+  score_mom double precision,
+  score_vol double precision,
+  score_volume double precision,
+  score_ver text,
+  ext_features jsonb not null default '{}'::jsonb,
+  updated_at timestamp with time zone not null default now(),
+  constraint features_1d_pkey primary key (asset, ts_utc)
+);
+
+-- src/etl_raw 擴充任務
+create table if not exists public.futures_basis_1d (
+  exchange text not null,
+  symbol text not null,
+  ts_utc timestamp with time zone not null,
+  date_utc date generated always as ((ts_utc at time zone 'UTC')::date) stored,
+  open_basis numeric,
+  close_basis numeric,
+  open_change numeric,
+  close_change numeric,
+  constraint futures_basis_1d_pkey primary key (exchange, symbol, ts_utc)
+);
+
+create table if not exists public.futures_whale_index_1d (
+  exchange text not null,
+  symbol text not null,
+  ts_utc timestamp with time zone not null,
+  date_utc date generated always as ((ts_utc at time zone 'UTC')::date) stored,
+  whale_index_value numeric,
+  constraint futures_whale_index_1d_pkey primary key (exchange, symbol, ts_utc)
+);
+
+create table if not exists public.futures_cgdi_index_1d (
+  ts_utc timestamp with time zone not null,
+  date_utc date generated always as ((ts_utc at time zone 'UTC')::date) stored,
+  cgdi_index_value numeric,
+  constraint futures_cgdi_index_1d_pkey primary key (ts_utc)
+);
+
+create table if not exists public.futures_cdri_index_1d (
+  ts_utc timestamp with time zone not null,
+  date_utc date generated always as ((ts_utc at time zone 'UTC')::date) stored,
+  cdri_index_value numeric,
+  constraint futures_cdri_index_1d_pkey primary key (ts_utc)
+);
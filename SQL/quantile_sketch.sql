@@ -0,0 +1,12 @@
+-- 每 (來源表, 欄位) 一份可合併的 t-digest 分位數草圖（common/sketch.py）
+-- watermark 之後的新列才會被併入；特徵任務取 p01/p99 不再需要全表排序
+
+create table if not exists public.quantile_sketch (
+  source_table text not null,
+  column_name text not null,
+  sketch jsonb not null,
+  n bigint not null default 0,
+  watermark timestamp with time zone,          -- 已併入的最大 ts_utc
+  updated_at timestamp with time zone not null default now(),
+  constraint quantile_sketch_pkey primary key (source_table, column_name)
+);
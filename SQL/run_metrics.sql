@@ -0,0 +1,20 @@
+-- 執行期指標（common/metrics.py，METRICS_PERSIST=1 時每次 run 結束寫入）
+-- 每列一個 (name, labels)：counter 的 value 為累計值；histogram 的 value 為總秒數，附 count / p50 / p95 / max
+create table if not exists public.run_metrics (
+  id bigserial primary key,
+  run_id text not null,
+  job text not null,
+  started_at timestamp with time zone not null,
+  name text not null,
+  labels jsonb not null default '{}'::jsonb,
+  kind text not null,                 -- counter | histogram
+  value double precision,
+  count bigint,
+  p50 double precision,
+  p95 double precision,
+  max double precision,
+  created_at timestamp with time zone not null default now()
+);
+
+create index if not exists run_metrics_job_started_idx on public.run_metrics (job, started_at);
+create index if not exists run_metrics_name_idx on public.run_metrics (name, started_at);
@@ -0,0 +1,41 @@
+-- 資產層現貨日線 rollup：public.spot_candles_1d 依 asset 聚合（價格取平均、量加總）
+-- 由 Dataupsert.ingest_spot_candles_1d 寫入後對受影響 (asset, ts_utc) 增量刷新；
+-- featuresETL 直接以 (asset, ts_utc) 主鍵範圍讀取，不再每次全表 regexp + group by。
+
+create table if not exists public.spot_asset_1d (
+  asset text not null,
+  ts_utc timestamp with time zone not null,
+  date_utc date generated always as ((ts_utc at time zone 'UTC')::date) stored,
+  px_open double precision,
+  px_high double precision,
+  px_low double precision,
+  px_close double precision,
+  vol_usd double precision,
+  n_src integer not null default 0,            -- 參與平均的 (exchange, symbol) 數
+  updated_at timestamp with time zone not null default now(),
+  constraint spot_asset_1d_pkey primary key (asset, ts_utc)
+);
+
+create index if not exists spot_asset_1d_ts_idx on public.spot_asset_1d (ts_utc);
+
+-- 增量刷新以 symbol + ts_utc 篩選來源列（spot_candles_1d 主鍵以 exchange 開頭，無法直接使用）
+create index if not exists spot_candles_1d_symbol_ts_idx on public.spot_candles_1d (symbol, ts_utc);
+
+-- 一次性回填（既有歷史）；之後由 ingestion 增量維護
+insert into public.spot_asset_1d (asset, ts_utc, px_open, px_high, px_low, px_close, vol_usd, n_src, updated_at)
+select
+  regexp_replace(upper(symbol), '(USDT|USDC|BUSD|TUSD|USD)$', '') as asset,
+  ts_utc,
+  avg(open::double precision),
+  avg(high::double precision),
+  avg(low::double precision),
+  avg(close::double precision),
+  sum(volume_usd::double precision),
+  count(*),
+  now()
+from public.spot_candles_1d
+group by 1, 2
+on conflict (asset, ts_utc) do update set
+  px_open = excluded.px_open, px_high = excluded.px_high, px_low = excluded.px_low,
+  px_close = excluded.px_close, vol_usd = excluded.vol_usd, n_src = excluded.n_src,
+  updated_at = now();
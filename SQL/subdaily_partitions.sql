@@ -0,0 +1,58 @@
+-- 小時級（4h / 1h）原始表：與對應 *_1d 同欄位、同主鍵，依 ts_utc 按月 range 分區，另建 BRIN(ts_utc)。
+-- Dataupsert 以 CG_INTERVAL=4h|1h 寫入 <base>_4h / <base>_1h，寫入前呼叫 ensure_month_partitions 補齊涵蓋月份；
+-- upsert 與區間讀取只碰到近期分區，舊月份可整個 detach / 壓縮保存。日線表列數小，維持原本不分區。
+
+-- 建立 parent 在 [d_from, d_to] 涵蓋月份缺少的分區（<parent>_pYYYYMM），回傳新建數量
+create or replace function public.ensure_month_partitions(parent text, d_from date, d_to date)
+returns integer
+language plpgsql
+as $$
+declare
+  m date := date_trunc('month', d_from)::date;
+  n integer := 0;
+  part text;
+begin
+  while m <= d_to loop
+    part := parent || '_p' || to_char(m, 'YYYYMM');
+    if to_regclass('public.' || quote_ident(part)) is null then
+      execute format(
+        'create table if not exists public.%I partition of public.%I for values from (%L) to (%L)',
+        part, parent,
+        (m::timestamp at time zone 'UTC'),
+        ((m + interval '1 month')::timestamp at time zone 'UTC'));
+      n := n + 1;
+    end if;
+    m := (m + interval '1 month')::date;
+  end loop;
+  return n;
+end
+$$;
+
+do $$
+declare
+  base text;
+  iv text;
+  t text;
+begin
+  foreach base in array array[
+    'futures_candles', 'spot_candles',
+    'futures_oi_agg', 'futures_oi_stablecoin', 'futures_oi_coin_margin',
+    'funding_oi_weight', 'funding_vol_weight',
+    'long_short_global', 'long_short_top_accounts', 'long_short_top_positions',
+    'liquidation_agg', 'orderbook_agg_futures', 'taker_vol_agg_futures',
+    'coinbase_premium_index', 'bitfinex_margin_long_short', 'borrow_interest_rate'
+  ] loop
+    foreach iv in array array['4h', '1h'] loop
+      t := base || '_' || iv;
+      -- 欄位、預設值、生成欄位（date_utc）與主鍵沿用日線表；主鍵皆含 ts_utc，可直接當分區鍵
+      execute format(
+        'create table if not exists public.%I (like public.%I including defaults including generated including constraints including indexes) partition by range (ts_utc)',
+        t, base || '_1d');
+      -- 時間順序寫入，BRIN 體積極小，區間掃描用；主鍵 btree 仍負責 upsert 衝突判定
+      execute format('create index if not exists %I on public.%I using brin (ts_utc) with (pages_per_range = 32)',
+                     t || '_ts_brin', t);
+      perform public.ensure_month_partitions(t, (now() - interval '1 month')::date, (now() + interval '1 month')::date);
+    end loop;
+  end loop;
+end
+$$;
@@ -1,7 +1,19 @@
 # common/db.py
-import os, socket, time
+"""
+共用連線層（Dataupsert / featuresETL / 特徵任務共用）
+- TCP keepalive，避免長時間 run 中閒置連線被中間設備切斷
+- IPv4 解析結果以 (host, port) 快取，重試/重連不再重新解析 DNS
+- ManagedConnection：照轉 psycopg2 連線；run_batch() 遇斷線自動重連並重跑當前批次
+- execute_values()：逐批 commit；`insert ... values %s on conflict ...` 形式自動轉成
+  server-side PREPARE（insert ... select * from unnest($n::type[])），同一表只 parse/plan 一次
+  （Supabase transaction pooler 的 6543 埠不支援跨交易的 prepared statement，自動停用）
+- write_batched()：批量依表自適應（朝 DB_BATCH_TARGET_SEC 每批延遲），statement timeout 時對半重試
+- CG_STORAGE=local：改連本機嵌入式 Postgres（common/storage.py），離線執行/測試不需憑證與網路
+"""
+import os, re, socket, time, hashlib
 import psycopg2
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from common import storage
 
 try:
     from dotenv import load_dotenv
@@ -16,6 +28,14 @@ def _getenv(*names, default=None):
             return v
     return default
 
+_IPV4: dict = {}
+
+def _resolve_ipv4(host: str, port: int):
+    key = (host, port)
+    if key not in _IPV4:
+        _IPV4[key] = next((ai[4][0] for ai in socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)), None)
+    return _IPV4[key]
+
 def _dsn_force_ipv4(dsn: str) -> str:
     try:
         u = urlparse(dsn.replace("postgres://", "postgresql://"))
@@ -24,7 +44,7 @@ def _dsn_force_ipv4(dsn: str) -> str:
         host, port = u.hostname, u.port or 5432
         if not host:
             return dsn
-        ipv4 = next((ai[4][0] for ai in socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)), None)
+        ipv4 = _resolve_ipv4(host, port)
         if not ipv4:
             return dsn
         q = dict(parse_qsl(u.query, keep_blank_values=True))
@@ -34,19 +54,36 @@ def _dsn_force_ipv4(dsn: str) -> str:
     except Exception:
         return dsn
 
-def connect(max_retries: int = 2, backoff: float = 1.5):
-    dsn = _getenv("SUPABASE_DB_URL", "DATABASE_URL")
+def _keepalive_kwargs() -> dict:
+    return dict(keepalives=1,
+                keepalives_idle=int(_getenv("PG_KEEPALIVE_IDLE", default="30")),
+                keepalives_interval=int(_getenv("PG_KEEPALIVE_INTERVAL", default="10")),
+                keepalives_count=int(_getenv("PG_KEEPALIVE_COUNT", default="5")))
+
+def resolve_dsn(dsn: str | None = None) -> str | None:
+    """CG_STORAGE=local 時一律改連本機嵌入式 Postgres；否則用傳入值或環境變數。"""
+    if storage.is_local():
+        return storage.local_dsn()
+    return dsn or _getenv("SUPABASE_DB_URL", "DATABASE_URL")
+
+def connect(max_retries: int = 2, backoff: float = 1.5, dsn: str | None = None, stmt_timeout: int | None = None):
+    """stmt_timeout（毫秒）未給則用 PG_STMT_TIMEOUT（預設 30000）；0 = 不限制。"""
+    dsn = resolve_dsn(dsn)
     if not dsn:
         raise RuntimeError("缺少 DATABASE_URL 或 SUPABASE_DB_URL")
     if _getenv("DB_FORCE_IPV4", default="1") == "1":
         dsn = _dsn_force_ipv4(dsn)
+    if stmt_timeout is None:
+        stmt_timeout = int(_getenv("PG_STMT_TIMEOUT", default="30000"))
 
     last_err = None
     for i in range(max_retries + 1):
         try:
-            conn = psycopg2.connect(dsn, connect_timeout=int(_getenv("PG_CONNECT_TIMEOUT", default="10") or 10))
+            conn = psycopg2.connect(dsn, connect_timeout=int(_getenv("PG_CONNECT_TIMEOUT", default="10") or 10),
+                                    **_keepalive_kwargs())
             with conn.cursor() as cur:
-                cur.execute("set timezone='UTC'; set statement_timeout = %s;", (int(_getenv("PG_STMT_TIMEOUT", default="30000")),))
+                cur.execute("set timezone='UTC'; set statement_timeout = %s;", (stmt_timeout,))
+            conn.commit()
             return conn
         except psycopg2.OperationalError as e:
             last_err = e
@@ -60,13 +97,238 @@ def ping(conn):
         cur.execute("select current_database(), current_user, inet_server_addr(), inet_server_port();")
         return cur.fetchone()
 
+# ---------------- 受管連線（重連 + 批次重試 + prepared upsert） ----------------
+_INSERT_VALUES = re.compile(r"^\s*insert\s+into\s+([\w.\"]+)\s*\(([^)]*)\)\s*values\s+%s\s*(.*?)\s*;?\s*$",
+                            re.I | re.S)
+
+def _use_prepare(dsn: str) -> bool:
+    mode = _getenv("PG_PREPARE", default="auto").lower()
+    if mode in ("0", "1"):
+        return mode == "1"
+    try:
+        return urlparse(dsn.replace("postgres://", "postgresql://")).port != 6543
+    except Exception:
+        return True
+
+class ManagedConnection:
+    """包住 psycopg2 連線；未定義的屬性（cursor/commit/rollback/closed/...）照轉給底層連線。"""
+
+    def __init__(self, dsn: str | None = None, stmt_timeout: int | None = None,
+                 retries: int | None = None, backoff: float = 2.0):
+        self._dsn = resolve_dsn(dsn) or ""
+        self._stmt_timeout = stmt_timeout
+        self.retries = int(_getenv("PG_BATCH_RETRIES", default="3")) if retries is None else retries
+        self.backoff = backoff
+        self.prepare = _use_prepare(self._dsn)
+        self._prepared: dict = {}   # sql -> (name, [型別]) 或 None（不適用，走 execute_values）
+        self._conn = connect(dsn=self._dsn or None, stmt_timeout=stmt_timeout)
+
+    _OWN = ("retries", "backoff", "prepare")
+
+    def __getattr__(self, attr):
+        return getattr(self._conn, attr)
+
+    def __setattr__(self, attr, value):
+        # conn.autocommit = True 之類的設定要落到底層連線
+        if attr.startswith("_") or attr in self._OWN:
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self._conn, attr, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 同 psycopg2：離開時 commit / rollback，不關閉連線
+        if self._conn.closed:
+            return False
+        if exc_type is None:
+            self._conn.commit()
+        else:
+            self._conn.rollback()
+        return False
+
+    @property
+    def raw(self):
+        return self._conn
+
+    def reconnect(self):
+        autocommit = self._conn.autocommit
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._prepared.clear()   # prepared statement 屬於舊 session
+        self._conn = connect(dsn=self._dsn or None, stmt_timeout=self._stmt_timeout)
+        self._conn.autocommit = autocommit
+
+    def run_batch(self, fn):
+        """fn(raw_conn) 需自行 commit 且可安全重跑（upsert）；連線已斷才重連重試，SQL 錯誤照常拋出。"""
+        from common import metrics
+        from common.utils import log
+        for i in range(self.retries + 1):
+            try:
+                return fn(self._conn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if i == self.retries or not self._conn.closed:
+                    raise
+                wait = self.backoff ** i
+                msg = " ".join(str(e).split())[:120]
+                log(f"[db] 連線中斷（{msg}），{wait:.0f}s 後重連並重跑本批（{i + 1}/{self.retries}）")
+                metrics.inc("db_reconnects")
+                time.sleep(wait)
+                self.reconnect()
+
+    def _prepared_for(self, cur, sql: str):
+        if sql in self._prepared:
+            return self._prepared[sql]
+        plan = None
+        m = _INSERT_VALUES.match(sql) if self.prepare else None
+        if m:
+            table, cols, rest = m.group(1), [c.strip() for c in m.group(2).split(",")], m.group(3)
+            cur.execute("savepoint cg_prepare")
+            try:
+                cur.execute("""
+                  select a.attname, format_type(a.atttypid, null)
+                    from pg_attribute a
+                   where a.attrelid = %s::regclass and a.attnum > 0 and not a.attisdropped
+                """, (table,))
+                types = dict(cur.fetchall())
+                if all(c in types for c in cols):
+                    tys = [types[c] for c in cols]
+                    name = "cg_ups_" + hashlib.md5(sql.encode()).hexdigest()[:12]
+                    args = ", ".join(f"${i + 1}::{t}[]" for i, t in enumerate(tys))
+                    cur.execute(f"prepare {name} ({', '.join(t + '[]' for t in tys)}) as "
+                                f"insert into {table} ({', '.join(cols)}) select * from unnest({args}) {rest}")
+                    plan = (name, tys)
+                cur.execute("release savepoint cg_prepare")
+            except psycopg2.Error:
+                cur.execute("rollback to savepoint cg_prepare")
+                plan = None
+        self._prepared[sql] = plan
+        return plan
+
+    def write_values(self, cur, sql: str, rows) -> int:
+        """單批寫入（不 commit）：可 prepare 就 execute 預備語句，否則 execute_values。"""
+        plan = self._prepared_for(cur, sql)
+        if plan is None:
+            from psycopg2.extras import execute_values as _ev
+            _ev(cur, sql, rows, page_size=min(len(rows), 10000))
+            return len(rows)
+        name, tys = plan
+        cur.execute(f"execute {name} ({', '.join('%s::' + t + '[]' for t in tys)})",
+                    [list(col) for col in zip(*rows)])
+        return len(rows)
+
+    def execute_values(self, sql: str, rows, page_size: int = 1000, before_commit=None, key: str | None = None) -> int:
+        """逐批寫入並 commit，批量由 BATCHER 依表自動調整（page_size 為初始值）；斷線只重跑當前批次。
+        before_commit(cur) 在最後一批的交易內呼叫（如 NOTIFY）。"""
+        def _write(conn, lo, hi):
+            with conn.cursor() as cur:
+                self.write_values(cur, sql, rows[lo:hi])
+                if hi >= len(rows) and before_commit is not None:
+                    before_commit(cur)
+            conn.commit()
+            return hi - lo
+        return write_batched(self, key or _table_key(sql), len(rows), _write, initial=page_size)
+
+def managed(dsn: str | None = None, stmt_timeout: int | None = None) -> ManagedConnection:
+    return ManagedConnection(dsn=dsn, stmt_timeout=stmt_timeout)
+
+# ---------------- 自適應批量（依寫入延遲調整，statement timeout 時對半重試） ----------------
+class AdaptiveBatcher:
+    """每個 key（通常是表名）一個批量：依上一批 rows/sec 朝 target_sec 調整，每次最多 ×2 或 ÷2。"""
+
+    def __init__(self, target_sec: float, min_rows: int, max_rows: int):
+        self.target_sec = target_sec
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.sizes: dict = {}
+        self.ceilings: dict = {}   # 曾逾時批量的 3/4；之後成長不再超過
+
+    def size(self, key: str, initial: int | None = None) -> int:
+        if key not in self.sizes:
+            self.sizes[key] = self._clamp(initial or self.min_rows)
+        return self.sizes[key]
+
+    def _clamp(self, n: int) -> int:
+        return max(self.min_rows, min(self.max_rows, int(n)))
+
+    def record(self, key: str, rows: int, seconds: float):
+        cur = self.size(key)
+        if rows < cur // 2:
+            return   # 尾批太小，固定開銷主導，不拿來估速率
+        ideal = rows / max(seconds, 1e-3) * self.target_sec
+        nxt = min(cur * 2, max(cur // 2, ideal), self.ceilings.get(key, self.max_rows))
+        self.sizes[key] = self._clamp(nxt)
+
+    def shrink(self, key: str, rows: int) -> int:
+        self.ceilings[key] = min(rows * 3 // 4, self.ceilings.get(key, self.max_rows))
+        self.sizes[key] = self._clamp(rows // 2)
+        return self.sizes[key]
+
+BATCHER = AdaptiveBatcher(target_sec=float(_getenv("DB_BATCH_TARGET_SEC", default="2.0")),
+                          min_rows=int(_getenv("DB_BATCH_MIN", default="200")),
+                          max_rows=int(_getenv("DB_BATCH_MAX", default="50000")))
+
+def _table_key(sql: str) -> str:
+    m = re.search(r"insert\s+into\s+([\w.\"]+)", sql, re.I)
+    return m.group(1) if m else "sql:" + hashlib.md5(sql.encode()).hexdigest()[:8]
+
+def write_batched(conn, key: str, n_rows: int, write_fn, initial: int | None = None, atomic: bool = False) -> int:
+    """write_fn(raw_conn, lo, hi) 寫入 [lo, hi) 並自行 commit、回傳列數。
+    批量依 BATCHER 調整；statement timeout（QueryCanceled）時 rollback、該批對半後重試，到 DB_BATCH_MIN 仍逾時才拋出。
+    conn 為 ManagedConnection 時另有斷線重連（run_batch）。
+    atomic=True：write_fn 不 commit，每批包在 SAVEPOINT 內，逾時只退回該批；整段由呼叫端一次 commit（不做斷線重跑）。"""
+    from psycopg2 import errors
+    from common import metrics
+    from common.utils import log
+    if atomic:
+        def run(fn):
+            with conn.cursor() as cur:
+                cur.execute("savepoint write_batched")
+            n = fn(conn)
+            with conn.cursor() as cur:
+                cur.execute("release savepoint write_batched")
+            return n
+    elif isinstance(conn, ManagedConnection):
+        run = conn.run_batch
+    else:
+        run = lambda fn: fn(conn)
+    done = total = 0
+    while done < n_rows:
+        hi = min(n_rows, done + BATCHER.size(key, initial))
+        t0 = time.perf_counter()
+        try:
+            total += run(lambda c: write_fn(c, done, hi)) or 0
+        except errors.QueryCanceled:
+            if atomic:
+                with conn.cursor() as cur:
+                    cur.execute("rollback to savepoint write_batched")
+            else:
+                conn.rollback()
+            if hi - done <= BATCHER.min_rows:
+                raise
+            size = BATCHER.shrink(key, hi - done)
+            metrics.inc("db_batch_splits", table=key)
+            log(f"[db] {key} 批次 {hi - done} 列逾時，改為 {size} 列重試")
+            continue
+        elapsed = time.perf_counter() - t0
+        metrics.observe("db_batch_seconds", elapsed, table=key)
+        BATCHER.record(key, hi - done, elapsed)
+        done = hi
+    return total
+
 def exec_values(conn, sql: str, rows, page_size: int = 1000):
+    if isinstance(conn, ManagedConnection):
+        return conn.execute_values(sql, rows, page_size=page_size)
     from psycopg2.extras import execute_values as _ev
-    total = 0
-    with conn.cursor() as cur:
-        for i in range(0, len(rows), page_size):
-            part = rows[i:i+page_size]
-            _ev(cur, sql, part, page_size=page_size)
-            total += len(part)
+
+    # 一般連線維持原本語意：全部列同一交易、最後一次 commit（批量仍自適應，逾時以 savepoint 退回該批）
+    def _write(c, lo, hi):
+        with c.cursor() as cur:
+            _ev(cur, sql, rows[lo:hi], page_size=hi - lo)
+        return hi - lo
+    total = write_batched(conn, _table_key(sql), len(rows), _write, initial=page_size, atomic=True)
     conn.commit()
     return total
@@ -0,0 +1,67 @@
+# common/feature_store.py
+import csv, io
+from common.utils import json_dumps_many
+
+MARKER_OVERLAP = "1 hour"   # apply_ns_defaults 每次回看的重疊時間
+
+def write_ext_features(conn, rows, score_ver=None) -> int:
+    """把 [(asset, date_utc, {ns_key: value})] 合併進 public.features_1d.ext_features。
+    COPY 進 staging 後一次 UPDATE；只觸及命名空間內容（或 score_ver）有變的列。不 commit。"""
+    if not rows:
+        return 0
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    for (asset, d, _), js in zip(rows, json_dumps_many([r[2] for r in rows])):
+        w.writerow((asset, d.isoformat(), js))
+    buf.seek(0)
+    with conn.cursor() as cur:
+        cur.execute("""
+          create temp table if not exists _stg_ext_features
+            (asset text, date_utc date, feats jsonb) on commit delete rows;
+          truncate _stg_ext_features;
+        """)
+        cur.copy_expert("copy _stg_ext_features (asset, date_utc, feats) from stdin with (format csv)", buf)
+        cur.execute("""
+          update public.features_1d f
+             set ext_features = coalesce(f.ext_features,'{}'::jsonb) || s.feats,
+                 score_ver    = coalesce(%(ver)s, f.score_ver)
+            from _stg_ext_features s
+           where f.asset = s.asset and f.date_utc = s.date_utc
+             and (not coalesce(f.ext_features,'{}'::jsonb) @> s.feats
+                  or f.score_ver is distinct from coalesce(%(ver)s, f.score_ver));
+        """, {"ver": score_ver})
+        return cur.rowcount
+
+def apply_ns_defaults(conn, ns: str, asset: str, defaults: dict) -> int:
+    """對 asset 尚未有任何 defaults 鍵（不存在或值為 JSON null）的列補上預設值（如 ETH 的 cpi_na=true）。
+    以 public.ext_features_marker 記錄已看過的 features_1d.updated_at，之後只看這之後新增/重寫的列
+    （回補較早日期的列同樣會被涵蓋）；無標記表時退回全掃。不 commit。"""
+    keys = list(defaults)
+    payload = json_dumps_many([defaults])[0]
+    missing = " and ".join("(ext_features->>%s) is null" for _ in keys)
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('public.ext_features_marker') is not null;")
+        tracked = bool(cur.fetchone()[0])
+        since = None
+        if tracked:
+            cur.execute("select applied_at from public.ext_features_marker where ns=%s and asset=%s for update;",
+                        (ns, asset))
+            row = cur.fetchone()
+            since = row[0] if row else None
+        # 標記為目前可見列的 max(updated_at)；每次回看 MARKER_OVERLAP，涵蓋 now() 較早但較晚 commit 的並行寫入
+        cur.execute(f"""
+          update public.features_1d
+             set ext_features = coalesce(ext_features,'{{}}'::jsonb) || %s::jsonb
+           where asset = %s and (%s::timestamptz is null or updated_at > %s::timestamptz - %s::interval)
+             and {missing};
+        """, (payload, asset, since, since, MARKER_OVERLAP, *keys))
+        n = cur.rowcount
+        if tracked:
+            cur.execute("""
+              insert into public.ext_features_marker (ns, asset, applied_at)
+              select %s, %s, max(updated_at) from public.features_1d where asset = %s
+              on conflict (ns, asset) do update set
+                applied_at = coalesce(excluded.applied_at, public.ext_features_marker.applied_at),
+                updated_at = now();
+            """, (ns, asset, asset))
+        return n
@@ -0,0 +1,117 @@
+# common/metrics.py
+"""
+執行期指標：計數器 + 直方圖（依 name + labels 分桶），run 結束輸出一行 JSON 摘要
+- inc("http_requests", endpoint=path) / observe("db_write_seconds", 0.12, table=t) / with timer(...):
+- 直方圖預設用秒桶 BUCKETS；非時間的量傳入對應單位的桶，如 observe("http_payload_bytes", n, buckets=BYTES_BUCKETS)
+- emit_summary(job, conn) 印出 "[metrics] {...}"；METRICS_PERSIST=1 且有 public.run_metrics
+  （SQL/run_metrics.sql）時逐項寫入供趨勢分析
+只用標準函式庫（Dataupsert 的執行環境沒有 numpy）；執行緒安全（特徵 DAG 平行任務共用）
+"""
+import os, json, time, uuid, threading, datetime as dt
+from contextlib import contextmanager
+
+PERSIST = os.getenv("METRICS_PERSIST", "0") == "1"
+# 直方圖桶上界；p50/p95 以桶上界估計。同一 name 的桶以第一次 observe 為準
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))   # 秒
+MB_BUCKETS = (0.0, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0, 256.0, 512.0, float("inf"))         # MB（≤0 落第一桶）
+BYTES_BUCKETS = (1 << 10, 4 << 10, 16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20, 64 << 20,
+                 float("inf"))                                                                    # bytes
+
+_LOCK = threading.Lock()
+_COUNTERS: dict = {}
+_HISTS: dict = {}
+RUN_ID = uuid.uuid4().hex[:12]
+STARTED_AT = dt.datetime.now(dt.timezone.utc)
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name: str, value: float = 1, **labels):
+    k = _key(name, labels)
+    with _LOCK:
+        _COUNTERS[k] = _COUNTERS.get(k, 0) + value
+
+def observe(name: str, value: float, buckets: tuple = BUCKETS, **labels):
+    k = _key(name, labels)
+    with _LOCK:
+        h = _HISTS.get(k)
+        if h is None:
+            h = _HISTS[k] = {"count": 0, "sum": 0.0, "max": float("-inf"), "ub": buckets,
+                             "buckets": [0] * len(buckets)}
+        h["count"] += 1
+        h["sum"] += value
+        h["max"] = max(h["max"], value)
+        for i, ub in enumerate(h["ub"]):
+            if value <= ub:
+                h["buckets"][i] += 1
+                break
+
+@contextmanager
+def timer(name: str, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+def _quantile(h: dict, q: float) -> float:
+    target, acc = q * h["count"], 0
+    for ub, c in zip(h["ub"], h["buckets"]):
+        acc += c
+        if acc >= target:
+            return min(ub, h["max"])
+    return h["max"]
+
+def total(name: str) -> float:
+    """某計數器跨所有 labels 的合計（如 run 中某段前後比較 http_errors）。"""
+    with _LOCK:
+        return sum(v for (n, _), v in _COUNTERS.items() if n == name)
+
+def snapshot(job: str = "") -> dict:
+    with _LOCK:
+        counters = [{"name": n, "labels": dict(l), "value": round(v, 6)}
+                    for (n, l), v in sorted(_COUNTERS.items())]
+        hists = [{"name": n, "labels": dict(l), "count": h["count"], "sum": round(h["sum"], 6),
+                  "max": round(h["max"], 6), "p50": round(_quantile(h, 0.5), 6), "p95": round(_quantile(h, 0.95), 6)}
+                 for (n, l), h in sorted(_HISTS.items())]
+    return {"job": job, "run_id": RUN_ID, "started_at": STARTED_AT.isoformat(timespec="seconds"),
+            "elapsed_sec": round((dt.datetime.now(dt.timezone.utc) - STARTED_AT).total_seconds(), 3),
+            "counters": counters, "histograms": hists}
+
+def reset():
+    """清空並開新的 run（常駐 worker 每批事件一份）。"""
+    global RUN_ID, STARTED_AT
+    with _LOCK:
+        _COUNTERS.clear()
+        _HISTS.clear()
+        RUN_ID = uuid.uuid4().hex[:12]
+        STARTED_AT = dt.datetime.now(dt.timezone.utc)
+
+def persist(conn, snap: dict) -> int:
+    """寫入 public.run_metrics；表不存在則略過。會 commit。"""
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('public.run_metrics') is not null;")
+        if not cur.fetchone()[0]:
+            return 0
+        rows = [(snap["run_id"], snap["job"], snap["started_at"], c["name"], json.dumps(c["labels"]),
+                 "counter", c["value"], None, None, None, None) for c in snap["counters"]]
+        rows += [(snap["run_id"], snap["job"], snap["started_at"], h["name"], json.dumps(h["labels"]),
+                  "histogram", h["sum"], h["count"], h["p50"], h["p95"], h["max"]) for h in snap["histograms"]]
+        cur.executemany("""
+          insert into public.run_metrics
+            (run_id, job, started_at, name, labels, kind, value, count, p50, p95, max)
+          values (%s, %s, %s, %s, %s::jsonb, %s, %s, %s, %s, %s, %s)
+        """, rows)
+    conn.commit()
+    return len(rows)
+
+def emit_summary(job: str, conn=None) -> dict:
+    snap = snapshot(job)
+    print("[metrics] " + json.dumps(snap, ensure_ascii=False, default=str), flush=True)
+    if PERSIST and conn is not None:
+        try:
+            persist(conn, snap)
+        except Exception as e:
+            conn.rollback()
+            print(f"[metrics] 寫入 run_metrics 失敗：{e}", flush=True)
+    return snap
@@ -0,0 +1,84 @@
+# common/profiling.py
+"""
+環境變數開關的剖析（未設定 CG_PROFILE 時 profile() 為空操作）
+- CG_PROFILE=cprofile：每個 scope（pipeline 任務 / 資產）一份 cProfile
+    <dir>/<job>-<stamp>-<scope>.prof（pstats / snakeviz 可讀）+ .txt（依 cumulative 排序前 N 名）
+- CG_PROFILE=tracemalloc：scope 結束時與開始時的快照比較，依行號列出新增配置前 N 名 + 峰值
+    <dir>/<job>-<stamp>-<scope>.mem.txt
+- CG_PROFILE_DIR（預設 profiles）、CG_PROFILE_TOP（預設 40）
+只用標準函式庫；scope 不可巢狀（同時只有一個 cProfile）
+"""
+import os, io, re, time, tracemalloc
+from contextlib import contextmanager
+
+MODE = os.getenv("CG_PROFILE", "").strip().lower()
+PROFILE_DIR = os.getenv("CG_PROFILE_DIR", "profiles")
+TOP = int(os.getenv("CG_PROFILE_TOP", "40"))
+STAMP = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+
+def enabled() -> bool:
+    return MODE in ("cprofile", "tracemalloc")
+
+def _path(job: str, scope: str, ext: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", scope)
+    return os.path.join(PROFILE_DIR, f"{job}-{STAMP}-{safe}{ext}")
+
+@contextmanager
+def profile(job: str, scope: str):
+    if MODE == "cprofile":
+        with _cprofile(job, scope):
+            yield
+    elif MODE == "tracemalloc":
+        with _tracemalloc(job, scope):
+            yield
+    else:
+        yield
+
+@contextmanager
+def _cprofile(job: str, scope: str):
+    import cProfile, pstats
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        path = _path(job, scope, ".prof")
+        prof.dump_stats(path)
+        buf = io.StringIO()
+        pstats.Stats(prof, stream=buf).sort_stats("cumulative").print_stats(TOP)
+        with open(path[:-5] + ".txt", "w", encoding="utf-8") as fh:
+            fh.write(buf.getvalue())
+        print(f"[profile] {scope} → {path}", flush=True)
+
+_TM_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+               tracemalloc.Filter(False, "<unknown>")]
+
+@contextmanager
+def _tracemalloc(job: str, scope: str):
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(int(os.getenv("CG_PROFILE_FRAMES", "1")))
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot().filter_traces(_TM_FILTERS)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        after = tracemalloc.take_snapshot().filter_traces(_TM_FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        stats = after.compare_to(before, "lineno")
+        path = _path(job, scope, ".mem.txt")
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write(f"# {job} / {scope}  elapsed={elapsed:.3f}s  "
+                     f"current={current / 2**20:.1f}MiB  peak={peak / 2**20:.1f}MiB\n")
+            fh.write(f"# 依新增配置大小排序前 {TOP} 名（size_diff / count_diff / 位置）\n")
+            for st in stats[:TOP]:
+                fh.write(f"{st.size_diff / 1024:+12.1f} KiB {st.count_diff:+9d}  {st.traceback}\n")
+        if started:
+            tracemalloc.stop()
+        print(f"[profile] {scope} peak={peak / 2**20:.1f}MiB → {path}", flush=True)
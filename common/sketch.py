@@ -0,0 +1,117 @@
+# common/sketch.py
+import json, math
+
+class TDigest:
+    """Merging t-digest（k1 尺度函數）；尾端分位（p01/p99）精度最高，可與其他草圖合併。"""
+
+    def __init__(self, delta: float = 200.0, centroids=None, vmin=None, vmax=None):
+        self.delta = float(delta)
+        self.c = [tuple(x) for x in (centroids or [])]   # [(mean, weight)]，依 mean 排序
+        self.vmin, self.vmax = vmin, vmax
+
+    @property
+    def n(self) -> float:
+        return sum(w for _, w in self.c)
+
+    def _k(self, q: float) -> float:
+        return self.delta / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def _compress(self, pts):
+        pts.sort(key=lambda p: p[0])
+        total = sum(w for _, w in pts)
+        out, done = [], 0.0
+        cm, cw = pts[0]
+        k_lo = self._k(0.0)
+        for m, w in pts[1:]:
+            if self._k((done + cw + w) / total) - k_lo <= 1.0:
+                cw += w
+                cm += (m - cm) * w / cw
+            else:
+                out.append((cm, cw))
+                done += cw
+                k_lo = self._k(done / total)
+                cm, cw = m, w
+        out.append((cm, cw))
+        self.c = out
+
+    def update(self, xs):
+        xs = [float(x) for x in xs if x is not None and not math.isnan(x)]
+        if not xs:
+            return self
+        lo, hi = min(xs), max(xs)
+        self.vmin = lo if self.vmin is None else min(self.vmin, lo)
+        self.vmax = hi if self.vmax is None else max(self.vmax, hi)
+        self._compress(self.c + [(x, 1.0) for x in xs])
+        return self
+
+    def merge(self, other: "TDigest"):
+        if other.c:
+            self.vmin = other.vmin if self.vmin is None else min(self.vmin, other.vmin)
+            self.vmax = other.vmax if self.vmax is None else max(self.vmax, other.vmax)
+            self._compress(self.c + other.c)
+        return self
+
+    def quantile(self, q: float):
+        """與 percentile_cont 相同的位置定義 q·(n-1)；未被合併的點（權重 1）結果精確。"""
+        if not self.c:
+            return None
+        n = self.n
+        pos = q * (n - 1)
+        # 各 centroid 中心所在的 0-based 位置
+        centers, cum = [], 0.0
+        for m, w in self.c:
+            centers.append((cum + (w - 1) / 2.0, m))
+            cum += w
+        if pos <= centers[0][0]:
+            p0, m0 = centers[0]
+            return self.vmin + (m0 - self.vmin) * (pos / p0) if p0 > 0 else m0
+        if pos >= centers[-1][0]:
+            p1, m1 = centers[-1]
+            span = (n - 1) - p1
+            return m1 + (self.vmax - m1) * ((pos - p1) / span) if span > 0 else m1
+        for (p0, m0), (p1, m1) in zip(centers, centers[1:]):
+            if p0 <= pos <= p1:
+                return m0 + (m1 - m0) * ((pos - p0) / (p1 - p0)) if p1 > p0 else m0
+        return centers[-1][1]
+
+    def to_json(self) -> str:
+        return json.dumps({"delta": self.delta, "min": self.vmin, "max": self.vmax,
+                           "c": [[m, w] for m, w in self.c]})
+
+    @classmethod
+    def from_json(cls, obj) -> "TDigest":
+        d = json.loads(obj) if isinstance(obj, str) else obj
+        return cls(d.get("delta", 200.0), d.get("c"), d.get("min"), d.get("max"))
+
+
+def refresh_quantiles(conn, table: str, column: str, qs=(0.01, 0.99), ts_col: str = "ts_utc",
+                      rebuild: bool = False):
+    """把 public.{table} 中 watermark 之後的新列併入 (table, column) 草圖並存回，回傳 {q: 值}。
+    若 public.quantile_sketch 不存在回傳 None（呼叫端自行退回精確查詢）。
+    已併入列的事後修訂不會反映；需要時以 rebuild=True 整表重建。不 commit，交由呼叫端。"""
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('public.quantile_sketch') is not null;")
+        if not cur.fetchone()[0]:
+            return None
+        cur.execute("""
+          select sketch, watermark from public.quantile_sketch
+           where source_table = %s and column_name = %s for update;
+        """, (table, column))
+        row = cur.fetchone()
+        td, wm = (TDigest.from_json(row[0]), row[1]) if (row and not rebuild) else (TDigest(), None)
+
+        cur.execute(f"""
+          select {column}::float8, {ts_col} from public.{table}
+           where {column} is not null {"and " + ts_col + " > %s" if wm is not None else ""};
+        """, (wm,) if wm is not None else None)
+        new = cur.fetchall()
+        if new:
+            td.update([v for v, _ in new])
+            wm = max(t for _, t in new) if wm is None else max(wm, max(t for _, t in new))
+            cur.execute("""
+              insert into public.quantile_sketch (source_table, column_name, sketch, n, watermark)
+              values (%s, %s, %s::jsonb, %s, %s)
+              on conflict (source_table, column_name) do update set
+                sketch = excluded.sketch, n = excluded.n, watermark = excluded.watermark, updated_at = now();
+            """, (table, column, td.to_json(), int(td.n), wm))
+    return {q: td.quantile(q) for q in qs}
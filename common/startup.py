@@ -0,0 +1,67 @@
+# common/startup.py
+"""
+匯入耗時報告（類似 python -X importtime，但不需改啟動指令）
+CG_IMPORTTIME=1 時，入口檔最先呼叫 install()：之後每個模組的載入時間（self / cumulative）都會記錄，
+程式結束時依 cumulative 排序印出前 CG_IMPORTTIME_TOP 名（預設 30）與總計。
+未設定時 install() 直接返回；本檔只用標準函式庫且不匯入任何重模組。
+"""
+import os, sys, time, atexit
+
+_STACK: list = []
+_TIMES: list = []          # (name, self_us, cum_us, depth)
+_T0 = time.perf_counter()
+
+class _LoaderProxy:
+    """包住真正的 loader，只攔 exec_module 計時，其餘屬性照轉。"""
+    def __init__(self, loader, name):
+        self._loader = loader
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._loader, attr)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        _STACK.append(0.0)
+        t0 = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            cum = time.perf_counter() - t0
+            child = _STACK.pop()
+            if _STACK:
+                _STACK[-1] += cum
+            _TIMES.append((self._name, (cum - child) * 1e6, cum * 1e6, len(_STACK)))
+
+class _TimingFinder:
+    def find_spec(self, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = _LoaderProxy(spec.loader, fullname)
+        return spec
+
+def report(top: int | None = None):
+    top = top or int(os.getenv("CG_IMPORTTIME_TOP", "30"))
+    total = sum(c for _, _, c, d in _TIMES if d == 0)
+    lines = [f"[importtime] {len(_TIMES)} 個模組，頂層匯入合計 {total / 1e3:.1f} ms"
+             f"（自啟用起 {(time.perf_counter() - _T0) * 1e3:.0f} ms）",
+             "[importtime]     self [us] | cumulative | imported package"]
+    for name, self_us, cum_us, depth in sorted(_TIMES, key=lambda t: -t[2])[:top]:
+        lines.append(f"[importtime] {self_us:13.0f} | {cum_us:10.0f} | {'  ' * depth}{name}")
+    print("\n".join(lines), flush=True)
+
+def install():
+    if os.getenv("CG_IMPORTTIME", "0") != "1":
+        return
+    if not any(isinstance(f, _TimingFinder) for f in sys.meta_path):
+        sys.meta_path.insert(0, _TimingFinder())
+        atexit.register(report)
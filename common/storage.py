@@ -0,0 +1,74 @@
+# common/storage.py
+"""
+儲存後端選擇（CG_STORAGE）
+- 未設定 / postgres：照舊連 SUPABASE_DB_URL / DATABASE_URL
+- local 或 local:<目錄>：本機嵌入式 Postgres（pgserver，pip install pgserver），資料放在 <目錄>（預設 .pgdata）；
+  第一次啟動時套用 SQL/schema.sql（date_utc 改為由 ts_utc 生成）、SQL/local_bootstrap.sql 與其餘 SQL/*.sql
+所有寫入路徑（Dataupsert.upsert、exec_values、featuresETL.upsert_features、特徵任務）走的是同一份 SQL：
+COPY、on conflict ... excluded、jsonb || 合併、生成欄位、LISTEN/NOTIFY 在本機與線上語意一致，不需要第二套方言。
+"""
+import os, re, glob
+
+SQL_DIR = os.path.join(os.path.dirname(__file__), "..", "SQL")
+_SERVER = None
+_URI = None
+
+def backend() -> str:
+    return (os.getenv("CG_STORAGE") or "postgres").split(":", 1)[0].lower()
+
+def is_local() -> bool:
+    return backend() == "local"
+
+def local_dir() -> str:
+    spec = os.getenv("CG_STORAGE") or ""
+    return spec.split(":", 1)[1] if ":" in spec else os.getenv("CG_LOCAL_PGDATA", ".pgdata")
+
+def local_dsn() -> str:
+    """啟動（或沿用同目錄已在跑的）嵌入式 Postgres，必要時建好結構，回傳連線 URI。"""
+    global _SERVER, _URI
+    if _URI is None:
+        try:
+            import pgserver
+        except ImportError as e:
+            raise SystemExit("CG_STORAGE=local 需要 pgserver：pip install pgserver") from e
+        path = os.path.abspath(local_dir())
+        os.makedirs(path, exist_ok=True)
+        _SERVER = pgserver.get_server(path)   # 同目錄多個程序共用一個 server，最後一個離開時停止
+        _URI = _SERVER.get_uri()
+        bootstrap(_URI)
+    return _URI
+
+def _schema_statements(path: str) -> list[str]:
+    # schema.sql 是線上結構的說明檔：逐表取出，ts_utc 表的 date_utc 改為生成欄位（同線上行為）
+    with open(path, encoding="utf-8") as fh:
+        stmts = re.findall(r"CREATE TABLE .*?\n\);", fh.read(), flags=re.S)
+    out = []
+    for s in stmts:
+        if "ts_utc timestamp" in s:
+            s = s.replace("date_utc date NOT NULL",
+                          "date_utc date GENERATED ALWAYS AS ((ts_utc AT TIME ZONE 'UTC')::date) STORED")
+        out.append(s.replace("CREATE TABLE ", "CREATE TABLE IF NOT EXISTS ", 1))
+    return out
+
+def bootstrap(uri: str) -> bool:
+    """空庫才建結構；回傳是否有建立。"""
+    import psycopg2
+    from common.utils import log
+    conn = psycopg2.connect(uri)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("select to_regclass('public.features_1d') is not null;")
+            if cur.fetchone()[0]:
+                return False
+            for stmt in _schema_statements(os.path.join(SQL_DIR, "schema.sql")):
+                cur.execute(stmt)
+            first = ["local_bootstrap.sql"]
+            rest = sorted(os.path.basename(p) for p in glob.glob(os.path.join(SQL_DIR, "*.sql")))
+            for name in first + [n for n in rest if n not in first and n != "schema.sql"]:
+                with open(os.path.join(SQL_DIR, name), encoding="utf-8") as fh:
+                    cur.execute(fh.read())
+        conn.commit()
+        log(f"[storage] 本機 Postgres 已初始化結構：{local_dir()}")
+        return True
+    finally:
+        conn.close()
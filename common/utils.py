@@ -1,18 +1,32 @@
 # common/utils.py
 import json, datetime as dt
-import numpy as np
 
 def log(msg: str):
     now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
     print(f"[{now}] {msg}", flush=True)
 
+def open_day_utc(now: dt.datetime | None = None) -> dt.datetime:
+    """當日（尚未收盤）日 K 的開盤時間 = 今日 00:00 UTC。
+    盤中模式（Dataupsert CG_INTRADAY=1）會把未收盤的當日 bar 寫進 *_1d 表；只該看已收盤資料的讀取端
+    （featuresETL、feat_family、build_features_labels）以 ts_utc < 此時間（date_utc < 此日期）截斷。"""
+    now = now or dt.datetime.now(dt.timezone.utc)
+    return dt.datetime(now.year, now.month, now.day, tzinfo=dt.timezone.utc)
+
+def _json_default(o):
+    # numpy 純量（np.float64 / np.int64 / np.bool_ …）不 import numpy 也能辨識
+    if type(o).__module__ == "numpy" and hasattr(o, "item"): return o.item()
+    if isinstance(o, (dt.datetime, dt.date)): return o.isoformat()
+    return str(o)
+
+# 共用單一 encoder；json.dumps(default=...) 每次呼叫都會重建一個
+_ENCODER = json.JSONEncoder(default=_json_default, ensure_ascii=False)
+
 def json_dumps(obj) -> str:
-    def _default(o):
-        if isinstance(o, (np.float32, np.float64)): return float(o)
-        if isinstance(o, (np.int32, np.int64)): return int(o)
-        if isinstance(o, (dt.datetime, dt.date)): return o.isoformat()
-        return str(o)
-    return json.dumps(obj, default=_default, ensure_ascii=False)
+    return _ENCODER.encode(obj)
+
+def json_dumps_many(objs) -> list:
+    enc = _ENCODER.encode
+    return [enc(o) for o in objs]
 
 def winsor(x, lo=None, hi=None):
     if x is None: return None
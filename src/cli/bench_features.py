@@ -0,0 +1,196 @@
+"""
+特徵計算基準測試 + 數值一致性檢查（不連 DB）
+
+- 合成 OHLCV：幾何隨機漫步 + 波動群聚，可設長度、資產數、NaN 比例、缺日比例（固定 seed，可重現）
+- 計時：compute_ta5_for_asset 整體，以及 EMA 矩陣 / ADX 矩陣 / rolling MAD / OLS 斜率 / pct-rank 各子元件、
+  feat_cpi._calc_series；每項取 --repeat 次最佳時間，回報 rows/sec 與 tracemalloc 峰值（另跑一次量測，不影響計時）
+- 一致性：以固定設定（GOLDEN_* ）重算分數，與 bench/golden_features.npz 比對（rtol/atol，NaN 位置須一致）
+- 速度閘門：--baseline <上次 --save 的 json>，任一項 rows/sec 低於基準的 1/--max-slowdown 即失敗
+
+用法：python -m src.cli.bench_features [--rows 3000] [--assets 3] [--nan-frac 0.01] [--gap-frac 0.01]
+                                       [--only ta5,ema_bank] [--save out.json] [--baseline out.json]
+                                       [--update-golden]
+結束碼：0 = 通過；1 = 與 golden 不一致或速度退步
+"""
+import os, sys, json, time, argparse, tracemalloc
+import numpy as np
+import pandas as pd
+import featuresETL as fe
+from src.etl_feat import feat_cpi
+from common.utils import log
+
+GOLDEN_PATH = os.getenv("BENCH_GOLDEN", os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "..", "bench", "golden_features.npz")))
+GOLDEN_ROWS, GOLDEN_ASSETS, GOLDEN_SEED = 800, 2, 7
+RTOL = float(os.getenv("BENCH_RTOL", "1e-7"))
+ATOL = float(os.getenv("BENCH_ATOL", "1e-9"))
+
+# ---------------- 合成資料 ----------------
+def synth_ohlcv(n: int, seed: int = 0, nan_frac: float = 0.0, gap_frac: float = 0.0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    # GARCH 風格的波動群聚，讓自適應窗（phi）在全範圍擺動
+    vol = np.empty(n)
+    v = 0.02
+    for i in range(n):
+        v = np.sqrt(1e-5 + 0.08 * (v * rng.standard_normal()) ** 2 + 0.9 * v * v)
+        vol[i] = v
+    r = vol * rng.standard_normal(n)
+    close = 100.0 * np.exp(np.cumsum(r))
+    open_ = np.r_[close[0], close[:-1]] * np.exp(0.1 * vol * rng.standard_normal(n))
+    span = np.abs(vol * rng.standard_normal(n)) * close
+    high = np.maximum(open_, close) + span
+    low = np.maximum(np.minimum(open_, close) - span, 1e-6)
+    volume = np.exp(13 + 0.5 * rng.standard_normal(n) + 10 * np.abs(r))
+    df = pd.DataFrame({
+        "ts_utc": pd.date_range("2018-01-01", periods=n, freq="D", tz="UTC"),
+        "px_open": open_, "px_high": high, "px_low": low, "px_close": close, "vol_usd": volume,
+    })
+    if nan_frac > 0:
+        for c in ("px_close", "vol_usd"):
+            df.loc[rng.random(n) < nan_frac, c] = np.nan
+    if gap_frac > 0:
+        df = df[rng.random(n) >= gap_frac].reset_index(drop=True)
+    return df
+
+def synth_assets(k: int, n: int, seed: int = 0, nan_frac: float = 0.0, gap_frac: float = 0.0) -> dict:
+    return {f"A{i}": synth_ohlcv(n, seed + i, nan_frac, gap_frac) for i in range(k)}
+
+def synth_rates(n: int, seed: int = 0, nan_frac: float = 0.0) -> list:
+    rng = np.random.default_rng(seed)
+    x = np.cumsum(rng.normal(0, 1e-4, n)) + rng.normal(0, 5e-4, n)
+    return [None if rng.random() < nan_frac else float(v) for v in x]
+
+# ---------------- 基準項目 ----------------
+def _series(df: pd.DataFrame):
+    df = df.sort_values("ts_utc")
+    return [df[c].astype(float) for c in ("px_open", "px_high", "px_low", "px_close", "vol_usd")]
+
+def _obv(C: pd.Series, V: pd.Series) -> pd.Series:
+    return (np.sign(C.diff()).fillna(0.0) * V).fillna(0.0).cumsum()
+
+def cases(frames: dict, rates: list) -> dict:
+    """名稱 → (無參數可呼叫, 處理列數)。"""
+    prepared = {a: _series(df) for a, df in frames.items()}
+    n = sum(len(df) for df in frames.values())
+
+    def each(fn):
+        return lambda: [fn(*s) for s in prepared.values()]
+
+    return {
+        "ta5":       (lambda: [fe.compute_ta5_for_asset(df) for df in frames.values()], n),
+        "ema_bank":  (each(lambda O, H, L, C, V: fe.ema_bank(C, 5, 120)), n),
+        "adx_bank":  (each(lambda O, H, L, C, V: fe.adx_bank(H, L, C, 10, 30)), n),
+        "rolling_mad": (each(lambda O, H, L, C, V: (
+            [fe.rolling_mean_abs_dev((H + L + C) / 3.0, w) for w in range(10, 31)],
+            fe.rolling_median_abs_dev(_obv(C, V).diff(), 252))), n),
+        "ols_slope": (each(lambda O, H, L, C, V: [fe.rolling_ols_slope(_obv(C, V), w) for w in range(10, 31)]), n),
+        # 用前值補洞後的波動序列：含 NaN 的 252 窗會被 min_periods 略過，量不到真正的排序成本
+        "pct_rank":  (each(lambda O, H, L, C, V: fe.pct_rank_rolling(np.log(C.ffill() / C.ffill().shift(1)).rolling(20).std(ddof=0), 252)), n),
+        "cpi_series": (lambda: feat_cpi._calc_series(rates), len(rates)),
+    }
+
+def measure(fn, rows: int, repeat: int) -> dict:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": round(best, 4), "rows": rows, "rows_per_sec": round(rows / best, 1),
+            "peak_mb": round(peak / 2**20, 2)}
+
+# ---------------- golden 一致性 ----------------
+SCORE_COLS = ["score_trend", "score_osc", "score_mom", "score_vol", "score_volume"]
+
+def golden_outputs() -> dict:
+    out = {}
+    for a, df in synth_assets(GOLDEN_ASSETS, GOLDEN_ROWS, GOLDEN_SEED, nan_frac=0.01, gap_frac=0.01).items():
+        scored = fe.compute_ta5_for_asset(df)
+        out[f"ta5_{a}"] = scored[SCORE_COLS].to_numpy(dtype=float, na_value=np.nan)
+    cols = feat_cpi._calc_series(synth_rates(GOLDEN_ROWS, GOLDEN_SEED, nan_frac=0.02))
+    for name, col in zip(("z60", "ewz20", "rank252", "spike2", "spike3", "streak"), cols):
+        out[f"cpi_{name}"] = np.array([np.nan if v is None else v for v in col], dtype=float)
+    return out
+
+def compare_golden(path: str) -> bool:
+    if not os.path.exists(path):
+        log(f"[bench] 找不到 golden：{path}（先以 --update-golden 產生）")
+        return False
+    ref = np.load(path)
+    got = golden_outputs()
+    ok = True
+    for k in sorted(set(ref.files) | set(got)):
+        if k not in ref.files or k not in got:
+            log(f"[bench] golden 欄位不一致：{k}")
+            ok = False
+            continue
+        a, b = got[k], ref[k]
+        if a.shape != b.shape or not np.array_equal(np.isnan(a), np.isnan(b)):
+            log(f"[bench] {k} 形狀或 NaN 位置不同：{a.shape} vs {b.shape}")
+            ok = False
+            continue
+        m = ~np.isnan(a)
+        diff = float(np.max(np.abs(a[m] - b[m]))) if m.any() else 0.0
+        close = np.allclose(a[m], b[m], rtol=RTOL, atol=ATOL)
+        ok &= close
+        if not close:
+            log(f"[bench] {k} 超出容差：max|Δ|={diff:.3e}（rtol={RTOL}, atol={ATOL}）")
+    log(f"[bench] golden 一致性：{'通過' if ok else '失敗'}（{len(got)} 組輸出）")
+    return ok
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=int(os.getenv("BENCH_ROWS", "3000")), help="每資產天數")
+    ap.add_argument("--assets", type=int, default=int(os.getenv("BENCH_ASSETS", "3")))
+    ap.add_argument("--nan-frac", type=float, default=0.01)
+    ap.add_argument("--gap-frac", type=float, default=0.01)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--only", type=str, default="", help="逗號分隔的項目名稱")
+    ap.add_argument("--save", type=str, default="", help="把結果寫成 json（之後可當 --baseline）")
+    ap.add_argument("--baseline", type=str, default="")
+    ap.add_argument("--max-slowdown", type=float, default=float(os.getenv("BENCH_MAX_SLOWDOWN", "1.25")))
+    ap.add_argument("--golden", type=str, default=GOLDEN_PATH)
+    ap.add_argument("--update-golden", action="store_true", help="以目前程式輸出覆寫 golden")
+    ap.add_argument("--no-golden", action="store_true")
+    args = ap.parse_args()
+
+    if args.update_golden:
+        os.makedirs(os.path.dirname(os.path.abspath(args.golden)), exist_ok=True)
+        np.savez_compressed(args.golden, **golden_outputs())
+        log(f"[bench] 已更新 golden：{args.golden}")
+        return
+
+    frames = synth_assets(args.assets, args.rows, args.seed, args.nan_frac, args.gap_frac)
+    rates = synth_rates(args.rows * args.assets, args.seed, args.nan_frac)
+    only = {x.strip() for x in args.only.split(",") if x.strip()}
+    report = {}
+    for name, (fn, rows) in cases(frames, rates).items():
+        if only and name not in only:
+            continue
+        report[name] = measure(fn, rows, args.repeat)
+        r = report[name]
+        log(f"[bench] {name:<12} {r['seconds']:>8.3f}s  {r['rows_per_sec']:>12,.0f} rows/s  peak {r['peak_mb']:>8.1f} MB")
+
+    ok = True
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            base = json.load(fh)["cases"]
+        for name, r in report.items():
+            if name in base:
+                # 以 rows/sec 比較，baseline 與本次的資料量可不同
+                ratio = base[name]["rows_per_sec"] / max(r["rows_per_sec"], 1e-9)
+                if ratio > args.max_slowdown:
+                    log(f"[bench] {name} 變慢 {ratio:.2f}×（上限 {args.max_slowdown}×）")
+                    ok = False
+    if not args.no_golden:
+        ok &= compare_golden(args.golden)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as fh:
+            json.dump({"config": vars(args), "cases": report}, fh, ensure_ascii=False, indent=2)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+訓練資料集建構：public.features_1d × 原始表 → (asset, date) 對齊的特徵/標籤矩陣
+
+- 每張表只查一次（已在 DB 端聚合到 (asset, date_utc)），整欄載入為 DataFrame
+- 以 pd.merge_asof 向量化 as-of 對齊：來源列在 date_utc + lag 日才視為可用（發布延遲），
+  最多沿用 max_stale 日的舊值
+- 輸出到 --out（預設 DATASET_DIR 或 data_1d/dataset）：
+    X.npy      float32，rows × features（np.load(..., mmap_mode="r") 直接映射）
+    y.npy      float32，rows × horizons（--horizons 為空則不輸出）
+    asset.npy / date.npy  列索引
+    meta.json  欄名、標籤定義、來源設定
+
+用法：DAYS=3 python -m src.cli.build_features_labels
+"""
+import os, json, argparse
+import datetime as dt
+import numpy as np
+import pandas as pd
+from common.db import connect
+from common.utils import log, open_day_utc
+
+PAIR_ASSET = "regexp_replace(upper(symbol), '(USDT|USDC|BUSD|TUSD|USD)$', '')"
+
+# asset=None 表示全市場共用（只依日期對齊）；lag = 該日資料幾天後才可用
+SOURCES = [
+    dict(table="funding_oi_weight_1d",  asset="symbol", cols={"fr_oiw": "close"}),
+    dict(table="funding_vol_weight_1d", asset="symbol", cols={"fr_volw": "close"}),
+    dict(table="futures_oi_agg_1d",     asset="symbol", cols={"oi_usd": "close"}, where="unit = 'usd'"),
+    dict(table="futures_oi_stablecoin_1d",  asset="symbol", cols={"oi_stable": "close"}),
+    dict(table="futures_oi_coin_margin_1d", asset="symbol", cols={"oi_coinm": "close"}),
+    dict(table="liquidation_agg_1d",    asset="symbol", cols={"liq_long": "long_liq_usd", "liq_short": "short_liq_usd"}),
+    dict(table="taker_vol_agg_futures_1d", asset="symbol", cols={"taker_buy": "buy_vol_usd", "taker_sell": "sell_vol_usd"}),
+    dict(table="orderbook_agg_futures_1d", asset="symbol", cols={"ob_bids": "bids_usd", "ob_asks": "asks_usd"}),
+    dict(table="long_short_global_1d",  asset=PAIR_ASSET, cols={"lsr_glb": "long_short_ratio"}),
+    dict(table="long_short_top_accounts_1d",  asset=PAIR_ASSET, cols={"lsr_top_acc": "long_short_ratio"}),
+    dict(table="long_short_top_positions_1d", asset=PAIR_ASSET, cols={"lsr_top_pos": "long_short_ratio"}),
+    dict(table="futures_basis_1d",      asset=PAIR_ASSET, cols={"basis": "close_basis"}),
+    dict(table="bitfinex_margin_long_short_1d", asset="symbol", cols={"bfx_long": "long_qty", "bfx_short": "short_qty"}),
+    dict(table="borrow_interest_rate_1d", asset="symbol", cols={"borrow_ir": "interest_rate"}),
+    dict(table="coinbase_premium_index_1d", asset=None, cols={"cb_premium": "premium_rate"}),
+    dict(table="etf_bitcoin_flow_1d",   asset=None, cols={"etf_flow": "total_flow_usd"}, lag=1),
+    dict(table="etf_bitcoin_net_assets_1d", asset=None, cols={"etf_aum": "net_assets_usd"}, lag=1),
+    dict(table="hk_etf_flow_1d",        asset=None, cols={"hk_etf_flow": "total_flow_usd"}, lag=1),
+    dict(table="idx_puell_multiple_daily", asset=None, cols={"puell": "puell_multiple"}, lag=1),
+    dict(table="idx_pi_cycle_daily",    asset=None, cols={"pi_ma110": "ma_110", "pi_ma350x2": "ma_350_x2"}, lag=1),
+]
+MAX_STALE_DAYS = 3
+BASE_COLS = ["px_open", "px_high", "px_low", "px_close", "vol_usd",
+             "score_trend", "score_osc", "score_mom", "score_vol", "score_volume"]
+
+def _read(conn, sql: str, params) -> pd.DataFrame:
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        cols = [c[0] for c in cur.description]
+        return pd.DataFrame(cur.fetchall(), columns=cols)
+
+def load_base(conn, since: dt.date | None, with_ext: bool) -> pd.DataFrame:
+    sql = f"""
+      select asset, date_utc, {", ".join(c + "::float8 as " + c for c in BASE_COLS)}
+             {", ext_features" if with_ext else ""}
+        from public.features_1d
+       where date_utc < %s {"and date_utc >= %s" if since else ""}
+       order by asset, date_utc
+    """
+    df = _read(conn, sql, (open_day_utc().date(),) + ((since,) if since else ()))
+    if with_ext and not df.empty:
+        ext = pd.DataFrame.from_records([e or {} for e in df.pop("ext_features")], index=df.index)
+        ext = ext.apply(pd.to_numeric, errors="coerce").astype("float64")  # 非數值鍵（字串等）轉 NaN
+        df = pd.concat([df, ext.add_prefix("x_")], axis=1)
+    df["date"] = pd.to_datetime(df["date_utc"])
+    return df.drop(columns="date_utc")
+
+def load_source(conn, src: dict, since: dt.date | None) -> pd.DataFrame:
+    sel = ", ".join(f"{src.get('agg', 'avg')}(({expr})::float8) as {name}" for name, expr in src["cols"].items())
+    # 只取已收盤日 K（盤中模式會寫入當日未收盤 bar）
+    where, params = ["date_utc < %s"], [open_day_utc().date()]
+    if src.get("where"):
+        where.append(f"({src['where']})")
+    if since:
+        where.append("date_utc >= %s")
+        params.append(since)
+    key = f"{src['asset']} as asset, " if src["asset"] else ""
+    sql = f"""
+      select {key}date_utc, {sel}
+        from public.{src['table']}
+       where {" and ".join(where)}
+       group by {"1, 2" if src["asset"] else "1"}
+    """
+    df = _read(conn, sql, params)
+    # 發布延遲：date_utc 的資料在 date_utc + lag 才能被使用
+    df["avail"] = pd.to_datetime(df["date_utc"]) + pd.to_timedelta(src.get("lag", 0), unit="D")
+    return df.drop(columns="date_utc").sort_values("avail")
+
+def asof_join(base: pd.DataFrame, src_df: pd.DataFrame, by_asset: bool) -> pd.DataFrame:
+    if src_df.empty:
+        return base
+    return pd.merge_asof(base.sort_values("date"), src_df, left_on="date", right_on="avail",
+                         by="asset" if by_asset else None, direction="backward",
+                         tolerance=pd.Timedelta(days=MAX_STALE_DAYS)).drop(columns="avail")
+
+def forward_returns(df: pd.DataFrame, horizons) -> pd.DataFrame:
+    """回傳同 index 的 fwd_ret_h = log(close[date + h 日] / close[date])（同資產、依日曆日對齊；
+    date + h 日沒有收盤則為 NaN，不會因缺日而拿到更遠的列）。"""
+    logc = np.log(df["px_close"].where(df["px_close"] > 0)).to_numpy(dtype=float)
+    s = pd.Series(logc, index=pd.MultiIndex.from_arrays([df["asset"], df["date"]]))
+    s = s[~s.index.duplicated(keep="last")]
+    out = {}
+    for h in horizons:
+        fut = pd.MultiIndex.from_arrays([df["asset"], df["date"] + pd.Timedelta(days=h)])
+        out[f"fwd_ret_{h}"] = s.reindex(fut).to_numpy() - logc
+    return pd.DataFrame(out, index=df.index)
+
+def check_labels(df: pd.DataFrame, horizons):
+    """輸出前驗證標籤對齊：以輸出列的 px_close 依 (asset, date + h 日) 合併重算 log(close[t+h] / close[t])，不一致即拋出。"""
+    base = pd.DataFrame({"asset": df["asset"].to_numpy(), "date": df["date"].to_numpy(),
+                         "logc": np.log(df["px_close"].where(df["px_close"] > 0)).to_numpy(dtype=float)})
+    asset = base["asset"].to_numpy()
+    for h in horizons:
+        fut = base.assign(date=base["date"] - pd.Timedelta(days=h)).rename(columns={"logc": "fut"}) \
+                  .drop_duplicates(["asset", "date"], keep="last")
+        want = (base.merge(fut, on=["asset", "date"], how="left")["fut"] - base["logc"]).to_numpy()
+        got = df[f"fwd_ret_{h}"].to_numpy(dtype=float)
+        bad = np.flatnonzero(~np.isclose(got, want, rtol=1e-9, atol=1e-12, equal_nan=True))
+        if len(bad):
+            i = int(bad[0])
+            raise RuntimeError(f"fwd_ret_{h} 與 close 不一致（{len(bad)} 列），例：{asset[i]} "
+                               f"{df['date'].iat[i]:%Y-%m-%d} 得 {got[i]}，應為 {want[i]}")
+
+def build(conn, days: int | None, out_dir: str, horizons, with_ext: bool = True):
+    since = None
+    load_since = None
+    if days:
+        since = dt.datetime.now(dt.timezone.utc).date() - dt.timedelta(days=days)
+        load_since = since - dt.timedelta(days=MAX_STALE_DAYS + max([s.get("lag", 0) for s in SOURCES]) + 1)
+
+    base = load_base(conn, load_since, with_ext)
+    if base.empty:
+        log("features_1d 無資料")
+        return 0
+    df = base
+    for src in SOURCES:
+        s_df = load_source(conn, src, load_since)
+        log(f"[dataset] {src['table']} {len(s_df)} 列")
+        df = asof_join(df, s_df, by_asset=bool(src["asset"]))
+    # merge_asof 回傳依日期排序的新 RangeIndex；標籤在最終表上依 (asset, date + h 日) 取值，不靠 index 或列位移
+    df = df.sort_values(["asset", "date"]).reset_index(drop=True)
+    label_cols = [f"fwd_ret_{h}" for h in horizons]
+    if horizons:
+        df = pd.concat([df, forward_returns(df, horizons)], axis=1)
+    if since is not None:
+        df = df[df["date"] >= pd.Timestamp(since)].reset_index(drop=True)
+    if horizons:
+        check_labels(df, horizons)
+
+    feat_cols = [c for c in df.columns if c not in ("asset", "date", *label_cols)]
+    os.makedirs(out_dir, exist_ok=True)
+    X = np.lib.format.open_memmap(os.path.join(out_dir, "X.npy"), mode="w+", dtype=np.float32,
+                                  shape=(len(df), len(feat_cols)))
+    X[:] = df[feat_cols].to_numpy(dtype=np.float32, na_value=np.nan)
+    X.flush()
+    if label_cols:
+        y = np.lib.format.open_memmap(os.path.join(out_dir, "y.npy"), mode="w+", dtype=np.float32,
+                                      shape=(len(df), len(label_cols)))
+        y[:] = df[label_cols].to_numpy(dtype=np.float32, na_value=np.nan)
+        y.flush()
+    np.save(os.path.join(out_dir, "asset.npy"), df["asset"].to_numpy(dtype=str))
+    np.save(os.path.join(out_dir, "date.npy"), df["date"].to_numpy(dtype="datetime64[D]"))
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as fh:
+        json.dump({"features": feat_cols, "labels": label_cols, "rows": len(df),
+                   "since": since.isoformat() if since else None,
+                   "max_stale_days": MAX_STALE_DAYS,
+                   "sources": [{"table": s["table"], "lag": s.get("lag", 0), "cols": list(s["cols"])} for s in SOURCES],
+                   "built_at": dt.datetime.now(dt.timezone.utc).isoformat()}, fh, ensure_ascii=False, indent=2)
+    log(f"[dataset] 輸出 {len(df)} 列 × {len(feat_cols)} 特徵、{len(label_cols)} 標籤 → {out_dir}")
+    return len(df)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--days", type=int, default=int(os.getenv("DAYS", "0")) or None,
+                    help="只輸出最近 N 日；預設全歷史")
+    ap.add_argument("--out", type=str, default=os.getenv("DATASET_DIR", os.path.join("data_1d", "dataset")))
+    ap.add_argument("--horizons", type=str, default=os.getenv("LABEL_HORIZONS", "1,5,20"),
+                    help="前瞻 log 報酬標籤天數，逗號分隔；空字串不輸出標籤")
+    ap.add_argument("--no_ext", action="store_true", help="不展開 ext_features")
+    args = ap.parse_args()
+    horizons = [int(h) for h in args.horizons.split(",") if h.strip()]
+    conn = connect()
+    try:
+        build(conn, args.days, args.out, horizons, with_ext=not args.no_ext)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+DB → 本地 Parquet 匯出（取代 data_1d/ 全量 CSV）
+
+- 表清單：SQL/schema.sql 內的 public.* 表 + features_1d
+- 具名（server-side）cursor 依 date_utc 排序分批 fetch，不把整張表載入記憶體
+- 依月份分區：<out>/<table>/month=YYYY-MM/part-0.parquet（欄式壓縮，預設 zstd）
+- 增量：<out>/_watermark.json 記錄各表已匯出的最新 date_utc；
+  下次只從「watermark - EXPORT_OVERLAP_DAYS」所在月份起重寫該月及之後的分區
+- numeric → float64、jsonb → JSON 字串
+
+用法：python -m src.cli.export_parquet_1d [--tables a,b] [--full] [--out data_1d/parquet]
+需 pyarrow（pip install pyarrow）；讀取：pd.read_parquet("<out>/<table>")
+"""
+import os, re, json, argparse, itertools
+import datetime as dt
+from common.db import connect
+from common.utils import log
+
+SCHEMA_SQL = os.path.join(os.path.dirname(__file__), "..", "..", "SQL", "schema.sql")
+EXTRA_TABLES = ["features_1d"]
+FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", "50000"))
+OVERLAP_DAYS = int(os.getenv("EXPORT_OVERLAP_DAYS", "3"))   # Dataupsert 會回補近幾日，重寫涵蓋的月份
+WATERMARK = "_watermark.json"
+
+def _arrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise SystemExit("匯出 Parquet 需要 pyarrow：pip install pyarrow") from e
+    return pa, pq
+
+def schema_tables(path: str = SCHEMA_SQL) -> list[str]:
+    with open(path, encoding="utf-8") as fh:
+        names = re.findall(r"CREATE TABLE public\.(\w+)", fh.read(), flags=re.I)
+    return names + [t for t in EXTRA_TABLES if t not in names]
+
+def table_columns(cur, table: str) -> list[tuple[str, str]]:
+    cur.execute("""
+      select column_name, data_type
+        from information_schema.columns
+       where table_schema = 'public' and table_name = %s
+       order by ordinal_position
+    """, (table,))
+    return cur.fetchall()
+
+def _select_expr(col: str, pg_type: str) -> str:
+    if pg_type == "numeric":
+        return f"{col}::float8 as {col}"
+    if pg_type in ("json", "jsonb"):
+        return f"{col}::text as {col}"
+    return col
+
+def _arrow_type(pa, pg_type: str):
+    return {
+        "numeric": pa.float64(), "double precision": pa.float64(), "real": pa.float32(),
+        "bigint": pa.int64(), "integer": pa.int32(), "smallint": pa.int16(),
+        "boolean": pa.bool_(), "date": pa.date32(),
+        "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+        "timestamp without time zone": pa.timestamp("us"),
+    }.get(pg_type, pa.string())
+
+def load_watermark(out_dir: str) -> dict:
+    p = os.path.join(out_dir, WATERMARK)
+    if not os.path.exists(p):
+        return {}
+    with open(p, encoding="utf-8") as fh:
+        return json.load(fh)
+
+def save_watermark(out_dir: str, wm: dict):
+    p = os.path.join(out_dir, WATERMARK)
+    try:
+        with open(p + ".tmp", "w", encoding="utf-8") as fh:
+            json.dump(wm, fh, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(p + ".tmp", p)
+    finally:
+        if os.path.exists(p + ".tmp"):
+            os.remove(p + ".tmp")
+
+def _start_month(wm_entry: dict | None) -> dt.date | None:
+    if not wm_entry or not wm_entry.get("max_date"):
+        return None
+    d = dt.date.fromisoformat(wm_entry["max_date"]) - dt.timedelta(days=OVERLAP_DAYS)
+    return d.replace(day=1)
+
+def export_table(conn, table: str, out_dir: str, since: dt.date | None, compression: str) -> dict | None:
+    pa, pq = _arrow()
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass(%s)", (f"public.{table}",))
+        if cur.fetchone()[0] is None:
+            log(f"[export] {table} 不存在，略過")
+            return None
+        cols = table_columns(cur, table)
+    names = [c for c, _ in cols]
+    if "date_utc" not in names:
+        log(f"[export] {table} 無 date_utc，略過")
+        return None
+    schema = pa.schema([(c, _arrow_type(pa, t)) for c, t in cols])
+    di = names.index("date_utc")
+
+    sql = (f"select {', '.join(_select_expr(c, t) for c, t in cols)} from public.{table}"
+           + (" where date_utc >= %s" if since else "") + " order by date_utc")
+    table_dir = os.path.join(out_dir, table)
+    n_rows, months, max_date = 0, [], None
+    writer, tmp_path, final_path, cur_month = None, None, None, None
+
+    def _close():
+        nonlocal writer
+        if writer is not None:
+            w, writer = writer, None
+            w.close()
+            os.replace(tmp_path, final_path)
+
+    try:
+        with conn.cursor() as c0:
+            c0.execute("set local statement_timeout = 0")   # 大表排序 + 長時間 fetch
+        with conn.cursor(name=f"export_{table}") as cur:
+            cur.itersize = FETCH_ROWS
+            cur.execute(sql, (since,) if since else None)
+            while True:
+                rows = cur.fetchmany(FETCH_ROWS)
+                if not rows:
+                    break
+                for month, grp in itertools.groupby(rows, key=lambda r: r[di].strftime("%Y-%m")):
+                    grp = list(grp)
+                    if month != cur_month:
+                        _close()
+                        part_dir = os.path.join(table_dir, f"month={month}")
+                        os.makedirs(part_dir, exist_ok=True)
+                        final_path = os.path.join(part_dir, "part-0.parquet")
+                        tmp_path = final_path + ".tmp"
+                        writer = pq.ParquetWriter(tmp_path, schema, compression=compression)
+                        cur_month = month
+                        months.append(month)
+                    arrays = [pa.array(col, type=f.type) for col, f in zip(zip(*grp), schema)]
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                n_rows += len(rows)
+                max_date = rows[-1][di]
+        _close()
+    finally:
+        # 任何失敗（寫入、close、rename）都不留下半成品 .tmp；已完成的月分區維持上次 rename 的版本
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception:
+                pass
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn.rollback()   # 唯讀交易；結束具名 cursor 與 set local
+    log(f"[export] {table}: {n_rows} 列 → {len(months)} 個月分區" + (f"（{months[0]}～{months[-1]}）" if months else ""))
+    return {"max_date": max_date.isoformat() if max_date else None, "rows": n_rows}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--out", type=str, default=os.getenv("EXPORT_DIR", os.path.join("data_1d", "parquet")))
+    ap.add_argument("--tables", type=str, default=os.getenv("EXPORT_TABLES", ""),
+                    help="逗號分隔；預設 schema.sql 全部 + features_1d")
+    ap.add_argument("--full", action="store_true", help="忽略 watermark 全量重匯")
+    ap.add_argument("--compression", type=str, default=os.getenv("EXPORT_COMPRESSION", "zstd"))
+    args = ap.parse_args()
+
+    _arrow()
+    tables = [t.strip() for t in args.tables.split(",") if t.strip()] or schema_tables()
+    os.makedirs(args.out, exist_ok=True)
+    wm = {} if args.full else load_watermark(args.out)
+    conn = connect()
+    try:
+        for t in tables:
+            since = None if args.full else _start_month(wm.get(t))
+            res = export_table(conn, t, args.out, since, args.compression)
+            if res is None:
+                continue
+            if res["max_date"] is None and t in wm:
+                continue   # 增量區間無資料，沿用舊 watermark
+            wm[t] = {**res, "exported_at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")}
+            save_watermark(args.out, wm)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
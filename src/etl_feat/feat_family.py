@@ -0,0 +1,142 @@
+"""
+通用特徵族引擎：對多張原始表 × 全部 symbol 一次向量化計算
+z60 / ewz20 / rank252 / spike2 / spike3 / streak（與 feat_cpi._calc_series 同定義），
+寫入 features_1d.ext_features 的 {ns}_* 命名空間。
+
+每個 spec：
+- ns     ：命名空間（鍵前綴）
+- table  ：來源表（public.*，需有 date_utc）
+- value  ：數值 SQL 運算式
+- asset  ：對應 features_1d.asset 的 SQL 運算式（預設 symbol）
+- agg    ：同 (asset, date_utc) 多列（多交易所/多組 exchange_list）時的聚合，預設 avg
+- where  ：額外篩選（可選）
+"""
+import datetime as dt
+import numpy as np
+import pandas as pd
+from common.db import managed
+from common.utils import log, open_day_utc
+from common.feature_store import write_ext_features
+
+PAIR_ASSET = "regexp_replace(upper(symbol), '(USDT|USDC|BUSD|TUSD|USD)$', '')"
+
+SPECS = [
+    dict(ns="fr_oiw",  table="funding_oi_weight_1d",  value="close"),
+    dict(ns="fr_volw", table="funding_vol_weight_1d", value="close"),
+    dict(ns="oi_chg",  table="futures_oi_agg_1d",     value="close / nullif(open, 0) - 1", where="unit = 'usd'"),
+    dict(ns="liq_imb", table="liquidation_agg_1d",
+         value="(long_liq_usd - short_liq_usd) / nullif(long_liq_usd + short_liq_usd, 0)"),
+    dict(ns="taker_imb", table="taker_vol_agg_futures_1d",
+         value="(buy_vol_usd - sell_vol_usd) / nullif(buy_vol_usd + sell_vol_usd, 0)"),
+    dict(ns="lsr_glb", table="long_short_global_1d",        value="long_short_ratio", asset=PAIR_ASSET),
+    dict(ns="lsr_top", table="long_short_top_positions_1d", value="long_short_ratio", asset=PAIR_ASSET),
+    dict(ns="basis",   table="futures_basis_1d",            value="close_basis",      asset=PAIR_ASSET),
+]
+
+TASK = dict(
+    name="feat_family",
+    kind="feature",
+    provides=[f"{s['ns']}_*" for s in SPECS],
+    depends_on=sorted({s["table"] for s in SPECS}),
+    default_days_back=400,
+)
+
+WARMUP_DAYS = 260       # 252D rank + 緩衝
+WINSOR = (0.01, 0.99)   # 每個 symbol 以載入期間的分位數截尾
+
+def load_matrix(conn, spec: dict, since: dt.date | None, until: dt.date | None) -> pd.DataFrame:
+    """回傳 index=date_utc、columns=asset 的 float 矩陣。"""
+    # 只讀已收盤日 K（盤中模式會寫入當日未收盤 bar）
+    where, params = [f"({spec['value']}) is not null", "date_utc < %s"], [open_day_utc().date()]
+    if since is not None:
+        where.append("date_utc >= %s"); params.append(since)
+    if until is not None:
+        where.append("date_utc <= %s"); params.append(until)
+    if spec.get("where"):
+        where.append(f"({spec['where']})")
+    sql = f"""
+      select date_utc, {spec.get('asset', 'symbol')} as asset,
+             {spec.get('agg', 'avg')}(({spec['value']})::float8) as v
+        from public.{spec['table']}
+       where {" and ".join(where)}
+       group by 1, 2
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        recs = cur.fetchall()
+    if not recs:
+        return pd.DataFrame(dtype=float)
+    df = pd.DataFrame(recs, columns=["date_utc", "asset", "v"])
+    return df.pivot(index="date_utc", columns="asset", values="v").sort_index().astype(float)
+
+def compute_families(X: pd.DataFrame, winsor=WINSOR) -> dict:
+    """X：time × symbol。回傳 {family: 同形狀 DataFrame}；缺值（NaN）等同 _calc_series 的 None。"""
+    if winsor:
+        X = X.clip(X.quantile(winsor[0]), X.quantile(winsor[1]), axis=1)
+    valid = X.notna()
+    started = valid.cummax()  # 各 symbol 首筆資料之前的列不計入平滑窗
+
+    mu = X.rolling(60, min_periods=1).mean()
+    sd = X.rolling(60, min_periods=2).std(ddof=1)
+    z = ((X - mu) / sd.where(sd > 0)).where(valid)
+
+    ewz = z.fillna(0.0).where(started).rolling(20, min_periods=1).mean()
+    rank = X.rolling(252, min_periods=1).rank(method="max", pct=True).where(valid)
+
+    zv = z.to_numpy()
+    spike2 = np.where(zv >= 2, 1, np.where(zv <= -2, -1, 0))
+    spike3 = np.where(zv >= 3, 1, np.where(zv <= -3, -1, 0))
+
+    # streak：連續同號（非 0）z 的長度，上限 10；以「最近一次斷點」的索引差向量化
+    sg = np.nan_to_num(np.sign(zv))
+    prev = np.vstack([np.zeros((1, sg.shape[1])), sg[:-1]])
+    brk = (sg != prev) | (sg == 0)
+    idx = np.arange(sg.shape[0])[:, None]
+    last_brk = np.maximum.accumulate(np.where(brk, idx, 0), axis=0)
+    streak = np.where(sg != 0, np.minimum(idx - last_brk + 1, 10), 0)
+
+    like = lambda a: pd.DataFrame(a, index=X.index, columns=X.columns)
+    return {"val": X, "z60": z, "ewz20": ewz, "rank252": rank,
+            "spike2": like(spike2), "spike3": like(spike3), "streak": like(streak)}
+
+_INT_FAMS = ("spike2", "spike3", "streak")
+
+def _to_rows(ns: str, fams: dict, since: dt.date | None) -> list:
+    """逐欄（非逐格）轉成 [(asset, date, {ns_key: value})]：NaN → None、spike/streak 為 int。"""
+    X = fams["val"]
+    keep = X.notna().to_numpy()
+    if since is not None:
+        keep = keep & (X.index >= since)[:, None]
+    ti, ai = np.nonzero(keep)
+    cols = {}
+    for k, v in fams.items():
+        col = v.to_numpy(dtype=float)[ti, ai]
+        cols[f"{ns}_{k}"] = pd.array(col, dtype="Int64") if k in _INT_FAMS else col
+    df = pd.DataFrame(cols).astype(object)
+    recs = df.where(df.notna(), None).to_dict("records")
+    return list(zip(X.columns.to_numpy()[ai], X.index.to_numpy()[ti], recs))
+
+def run(conn, since=None, until=None, days_back=None, only=None):
+    if since is None:
+        base = until or dt.datetime.now(dt.timezone.utc).date()
+        since = base - dt.timedelta(days=(days_back or TASK["default_days_back"]))
+    load_from = since - dt.timedelta(days=WARMUP_DAYS)
+    out = {}
+    for spec in SPECS:
+        if only and spec["ns"] not in only:
+            continue
+        X = load_matrix(conn, spec, load_from, until)
+        if X.empty:
+            out[spec["ns"]] = 0
+            continue
+        rows = _to_rows(spec["ns"], compute_families(X), since)
+        out[spec["ns"]] = write_ext_features(conn, rows)
+        conn.commit()
+        log(f"[feat_family] {spec['ns']} ← {spec['table']}：{X.shape[1]} 資產 × {X.shape[0]} 日，更新 {out[spec['ns']]} 列")
+    return {"updated_rows": out, "start": since, "end": until}
+
+if __name__ == "__main__":
+    conn = managed()
+    log("DB 連線 OK")
+    print(conn.run_batch(run))
+    conn.close()
@@ -0,0 +1,216 @@
+"""
+特徵任務 DAG 執行器
+- 探索 src/etl_feat 下宣告 TASK（且有 run(conn, ...)）的模組
+- depends_on 若符合其他任務的 provides（如 "cpi_*"）即為任務相依，否則視為上游表
+- 上游表以「每月列數 + 內容摘要」為簽章（整表、不限近窗，當日未收盤 bar 除外）；與上次成功時比對，
+  有變動的最早月份起算 since 傳給任務 run(conn, since=...)，任務自行往前回溫；上游任務之後又成功跑過也會執行
+  （沿用上游任務本輪的 since）
+- 同一層彼此獨立的任務平行執行（各自一條連線）
+
+用法：python -m src.etl_feat.runner [--only feat_cpi,...] [--force]
+水位存在 public.feature_task_state（SQL/feature_task_state.sql）；表不存在時每個任務都以預設區間執行、不記水位
+"""
+from common import startup
+startup.install()   # CG_IMPORTTIME=1 時回報各模組匯入耗時
+
+import os, json, argparse, fnmatch, importlib, pkgutil
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from common import metrics
+from common.db import managed
+from common.utils import log, open_day_utc
+
+WORKERS = int(os.getenv("FEAT_DAG_WORKERS", "4"))
+_NOT_TASKS = {"runner", "worker"}
+
+def discover(names=None) -> dict:
+    """回傳 {task_name: module}。
+    names 給定且都對得到模組檔名（慣例 TASK["name"] == 模組名）時只匯入這些模組，
+    不為了一個任務把 pandas/numpy 等其他任務的相依全載進來；對不到則退回全部探索。"""
+    pkg = importlib.import_module("src.etl_feat")
+    mods = [m.name for m in pkgutil.iter_modules(pkg.__path__)
+            if not m.name.startswith("_") and m.name not in _NOT_TASKS]
+    if names and set(names) <= set(mods):
+        mods = [m for m in mods if m in names]
+    tasks = {}
+    for name in mods:
+        mod = importlib.import_module(f"src.etl_feat.{name}")
+        task = getattr(mod, "TASK", None)
+        if isinstance(task, dict) and callable(getattr(mod, "run", None)):
+            tasks[task["name"]] = mod
+    return tasks
+
+def _provider(dep: str, tasks: dict, me: str):
+    for name, mod in tasks.items():
+        if name != me and any(dep == p or fnmatch.fnmatch(dep, p) for p in mod.TASK.get("provides", [])):
+            return name
+    return None
+
+def build_dag(tasks: dict):
+    """回傳 (levels, upstream)：levels 為拓撲分層的任務名；upstream[t] = {"tasks": [...], "tables": [...]}。"""
+    upstream = {}
+    for name, mod in tasks.items():
+        ups = {"tasks": [], "tables": []}
+        for dep in mod.TASK.get("depends_on", []):
+            p = _provider(dep, tasks, name)
+            (ups["tasks"] if p else ups["tables"]).append(p or dep)
+        upstream[name] = ups
+    levels, done = [], set()
+    while len(done) < len(tasks):
+        ready = sorted(t for t in tasks if t not in done and all(u in done for u in upstream[t]["tasks"]))
+        if not ready:
+            raise RuntimeError(f"特徵任務相依出現循環：{sorted(set(tasks) - done)}")
+        levels.append(ready)
+        done.update(ready)
+    return levels, upstream
+
+def table_signature(cur, table: str) -> str:
+    # 整表按月的列數 + 內容摘要（JSON {"YYYY-MM": "n|md5"}）；日線表每月至多數千列，整表掃一次成本低，
+    # 可抓到任何舊日期的修訂/回補。當日未收盤 bar（盤中模式持續改寫）不計
+    cur.execute(f"""
+      select to_char(t.ts_utc at time zone 'UTC', 'YYYY-MM'), count(*), md5(string_agg(t::text, '|' order by t::text))
+        from public.{table} t
+       where t.ts_utc < %s
+       group by 1;
+    """, (open_day_utc(),))
+    return json.dumps({m: f"{n}|{h}" for m, n, h in cur.fetchall()}, sort_keys=True)
+
+def changed_since(old: str | None, new: str) -> dt.date | None:
+    """兩份表簽章之間最早有變動的月份第一天；無舊簽章（或舊格式）時回傳 None = 任務預設區間。"""
+    try:
+        old_m = json.loads(old) if old else None
+    except ValueError:
+        old_m = None
+    if not isinstance(old_m, dict):
+        return None
+    new_m = json.loads(new)
+    diff = [m for m in set(old_m) | set(new_m) if old_m.get(m) != new_m.get(m)]
+    return dt.date.fromisoformat(min(diff) + "-01") if diff else None
+
+def load_state(cur) -> dict | None:
+    """{task: {source: signature}}；public.feature_task_state 不存在時回傳 None。"""
+    cur.execute("select to_regclass('public.feature_task_state') is not null;")
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute("select task, source, signature from public.feature_task_state;")
+    state = {}
+    for task, source, sig in cur.fetchall():
+        state.setdefault(task, {})[source] = sig
+    return state
+
+def save_state(conn, task: str, sigs: dict):
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('public.feature_task_state') is not null;")
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return
+        for source, sig in sigs.items():
+            cur.execute("""
+              insert into public.feature_task_state (task, source, signature) values (%s, %s, %s)
+              on conflict (task, source) do update set signature = excluded.signature, updated_at = now();
+            """, (task, source, sig))
+    conn.commit()
+
+def current_signatures(cur, name: str, upstream: dict, state: dict, table_sigs: dict) -> dict:
+    sigs = {}
+    for t in upstream[name]["tables"]:
+        if t not in table_sigs:
+            table_sigs[t] = table_signature(cur, t)
+        sigs[t] = table_sigs[t]
+    for u in upstream[name]["tasks"]:
+        sigs[f"task:{u}"] = state.get(u, {}).get("@self", "")
+    return sigs
+
+def plan_task(sigs: dict, prev: dict, spans: dict):
+    """比對上次成功時的簽章：回傳 (要不要跑, since)。since=None 表示任務預設區間。"""
+    changed = [k for k in sigs if sigs[k] != prev.get(k)]
+    if not changed:
+        return False, None
+    since = []
+    for k in changed:
+        if k.startswith("task:"):
+            since.append(spans.get(k[5:]))      # 上游任務本輪沒跑（外部觸發）→ 預設區間
+        else:
+            since.append(changed_since(prev.get(k), sigs[k]))
+    return True, (None if None in since else min(since))
+
+def run_task(mod, sigs: dict, **kwargs):
+    """單一任務：獨立連線執行，成功後記錄上游簽章與自身完成時間。"""
+    name = mod.TASK["name"]
+    conn = managed()
+    try:
+        with metrics.timer("task_seconds", task=name):
+            # 任務皆為 upsert，可安全重跑；連線中斷時重連再跑一次
+            res = conn.run_batch(lambda c: mod.run(c, **kwargs))
+        done_at = dt.datetime.now(dt.timezone.utc).isoformat()
+        save_state(conn, name, {**sigs, "@self": done_at})
+        log(f"[{name}] 完成 {res}")
+        return name, True, res
+    except Exception as e:
+        conn.rollback()
+        metrics.inc("task_failures", task=name)
+        log(f"[{name}] 失敗：{e}")
+        return name, False, e
+    finally:
+        conn.close()
+
+def run_dag(only=None, force=False):
+    tasks = discover(only)
+    if only:
+        tasks = {k: v for k, v in tasks.items() if k in only}
+    levels, upstream = build_dag(tasks)
+    log(f"特徵任務 {len(tasks)} 個，分 {len(levels)} 層：{levels}")
+
+    conn = managed()
+    failed, spans = [], {}
+    try:
+        for level in levels:
+            with conn.cursor() as cur:
+                state = load_state(cur)
+                if state is None:
+                    log("public.feature_task_state 不存在（SQL/feature_task_state.sql）：全部以預設區間執行，不記水位")
+                table_sigs = {}
+                todo = []
+                for name in level:
+                    if any(u in failed for u in upstream[name]["tasks"]):
+                        log(f"[{name}] 上游失敗，略過")
+                        failed.append(name)
+                        continue
+                    if state is None:
+                        todo.append((tasks[name], {}, None))
+                        continue
+                    sigs = current_signatures(cur, name, upstream, state, table_sigs)
+                    run, since = plan_task(sigs, state.get(name, {}), spans)
+                    if force:
+                        run, since = True, None
+                    if not run:
+                        log(f"[{name}] 上游無變動，略過")
+                        continue
+                    log(f"[{name}] 上游有變動，" + (f"自 {since} 重算" if since else "以預設區間重算"))
+                    todo.append((tasks[name], sigs, since))
+            conn.commit()
+            if not todo:
+                continue
+            with ThreadPoolExecutor(max_workers=max(1, min(WORKERS, len(todo)))) as ex:
+                for (mod, _, since), (name, ok, _) in zip(todo, ex.map(lambda a: run_task(a[0], a[1], since=a[2]), todo)):
+                    if ok:
+                        spans[name] = since
+                    else:
+                        failed.append(name)
+    finally:
+        metrics.emit_summary("feat_dag", conn)
+        conn.close()
+    if failed:
+        raise SystemExit(f"特徵任務失敗：{failed}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--only", type=str, default=os.getenv("FEAT_TASKS", None),
+                    help="逗號分隔任務名，預設全部")
+    ap.add_argument("--force", action="store_true", help="忽略上游水位，全部重跑")
+    args = ap.parse_args()
+    only = [x.strip() for x in args.only.split(",") if x.strip()] if args.only else None
+    run_dag(only=only, force=args.force)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+事件驅動特徵 worker
+- LISTEN Dataupsert 在入庫 commit 時發出的 NOTIFY（頻道 CG_NOTIFY_CHANNEL，預設 cg_ingest）
+- payload = {"table", "from", "to", "rows"}；累積 FEAT_WORKER_DEBOUNCE 秒內的事件後合併
+- 只看已收盤日：to 截到昨日，整段落在今日（盤中模式的未收盤 bar）的事件直接略過；
+  同一表同一區間內容（列數 + 摘要）與上次觸發時相同也略過，盤中每 5 分鐘重寫昨日 bar 不會反覆重算
+- 找出 depends_on 含受影響表的任務（及其下游），依 DAG 分層以 since = 受影響第一天重算
+  （任務自行往前回溫；until 不設限，之後日期的滾動視窗同樣涵蓋受影響日）
+
+用法：python -m src.etl_feat.worker（render.yaml 的 coinglass-cron worker）
+"""
+import os, json, time, select
+import datetime as dt
+import psycopg2
+from common import metrics
+from common.db import connect
+from common.utils import log, open_day_utc
+from src.etl_feat.runner import discover, build_dag, run_task, current_signatures, load_state
+
+CHANNEL = os.getenv("CG_NOTIFY_CHANNEL", "cg_ingest")
+DEBOUNCE_SEC = float(os.getenv("FEAT_WORKER_DEBOUNCE", "5"))
+POLL_SEC = float(os.getenv("FEAT_WORKER_POLL", "30"))
+
+def affected_tasks(pending: dict, levels, upstream) -> list:
+    """回傳依 DAG 順序排列的 [(task, since_date, until_date)]；下游沿用上游的日期區間。"""
+    spans = {}
+    for level in levels:
+        for name in level:
+            lo = hi = None
+            for t in upstream[name]["tables"]:
+                if t in pending:
+                    lo = min(lo or pending[t][0], pending[t][0])
+                    hi = max(hi or pending[t][1], pending[t][1])
+            for u in upstream[name]["tasks"]:
+                if u in spans:
+                    lo = min(lo or spans[u][0], spans[u][0])
+                    hi = max(hi or spans[u][1], spans[u][1])
+            if lo is not None:
+                spans[name] = (lo, hi)
+    return [(name, *spans[name]) for level in levels for name in level if name in spans]
+
+def dispatch(conn, pending: dict, tasks: dict, levels, upstream):
+    todo = affected_tasks(pending, levels, upstream)
+    if not todo:
+        log(f"事件 {sorted(pending)} 無對應特徵任務")
+        return
+    for name, lo, hi in todo:
+        with conn.cursor() as cur:
+            sigs = current_signatures(cur, name, upstream, load_state(cur) or {}, {})
+        log(f"[{name}] 觸發：{lo}~{hi}")
+        run_task(tasks[name], sigs, since=lo)
+    # 常駐程序：每批事件各輸出一份摘要
+    metrics.emit_summary("feat_worker", conn)
+    metrics.reset()
+
+def span_signature(cur, table: str, lo: dt.date, hi: dt.date) -> str:
+    cur.execute(f"""
+      select count(*), md5(coalesce(string_agg(t::text, '|' order by t::text), ''))
+        from public.{table} t
+       where t.date_utc between %s and %s;
+    """, (lo, hi))
+    n, h = cur.fetchone()
+    return f"{n}|{h}"
+
+def closed_changes(conn, batch: dict, seen: dict) -> dict:
+    """截掉今日未收盤 bar；內容與上次觸發時相同的 (表, 區間) 略過。seen 跨批保留。"""
+    last_closed = open_day_utc().date() - dt.timedelta(days=1)
+    out = {}
+    with conn.cursor() as cur:
+        for table, (lo, hi) in batch.items():
+            hi = min(hi, last_closed)
+            if lo > hi:
+                continue
+            sig = span_signature(cur, table, lo, hi)
+            if seen.get(table) == (lo, hi, sig):
+                continue
+            seen[table] = (lo, hi, sig)
+            out[table] = (lo, hi)
+    return out
+
+def listen_forever():
+    tasks = discover()
+    levels, upstream = build_dag(tasks)
+    log(f"特徵 worker 啟動，LISTEN {CHANNEL}；任務 {levels}")
+    conn = connect()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"listen {CHANNEL};")
+    pending, last_at, seen = {}, 0.0, {}
+    try:
+        while True:
+            if select.select([conn], [], [], min(POLL_SEC, DEBOUNCE_SEC) if pending else POLL_SEC) != ([], [], []):
+                conn.poll()
+                while conn.notifies:
+                    n = conn.notifies.pop(0)
+                    try:
+                        ev = json.loads(n.payload)
+                        lo, hi = dt.date.fromisoformat(ev["from"]), dt.date.fromisoformat(ev["to"])
+                    except Exception:
+                        log(f"略過無法解析的事件：{n.payload}")
+                        continue
+                    cur_lo, cur_hi = pending.get(ev["table"], (lo, hi))
+                    pending[ev["table"]] = (min(cur_lo, lo), max(cur_hi, hi))
+                    last_at = time.time()
+            if pending and time.time() - last_at >= DEBOUNCE_SEC:
+                batch, pending = pending, {}
+                changed = closed_changes(conn, batch, seen)
+                if changed:
+                    dispatch(conn, changed, tasks, levels, upstream)
+                else:
+                    log(f"事件 {sorted(batch)} 只涉及今日未收盤 bar 或內容未變，略過")
+    finally:
+        conn.close()
+
+def main():
+    while True:
+        try:
+            listen_forever()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            log(f"LISTEN 連線中斷：{e}，10 秒後重連")
+            time.sleep(10)
+
+if __name__ == "__main__":
+    main()